@@ -0,0 +1,254 @@
+#!/usr/bin/python
+
+import os
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows
+import createDB
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark KEGG parsing and loading on synthetic data")
+    parser.add_argument("--folder", default="bench_data", help="folder for generated KEGG files")
+    parser.add_argument("--scales", default="1000,10000,50000", help="comma separated numbers of compounds")
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = {"commit": git_commit(), "python": platform.python_version(), "time": time.time(), "runs": []}
+    for scale in [int(s) for s in args.scales.split(",")]:
+        folder = os.path.join(args.folder, str(scale))
+        files = generate_kegg_data(folder, scale, seed=args.seed)
+        print("Benchmarking", scale, "compounds")
+        results["runs"].extend(benchmark_parsers(files, scale))
+        results["runs"].extend(benchmark_loaders(files, scale))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to", args.output)
+    return 0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Generate synthetic reaction, enzyme, rclass, compound, pathway.list and kgml files
+# Records use the column 12 layout and /// terminators of the KEGG flat files.  The number of reactions equals the
+# number of compounds, with half as many reaction classes and a tenth as many enzymes
+def generate_kegg_data(folder, n_compounds, n_pathways=50, n_kgml=None, seed=1):
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(folder, "kgml", "ko"), exist_ok=True)
+    n_reactions = n_compounds
+    n_rclass = max(1, n_compounds // 2)
+    n_enzymes = max(1, n_compounds // 10)
+    if n_kgml is None:
+        n_kgml = n_pathways
+    pathways = ["{p:05d}".format(p=10 + 10 * i) for i in range(n_pathways)]
+
+    def compound(i):
+        return "C{i:05d}".format(i=i + 1)
+
+    def enzyme(i):
+        return "{a}.{b}.{c}.{d}".format(a=i % 7 + 1, b=i // 7 % 20 + 1, c=i // 140 % 20 + 1, d=i // 2800 + 1)
+
+    # compound pairs used by reaction classes
+    rpairs = [(compound(rng.randrange(n_compounds)), compound(rng.randrange(n_compounds))) for _ in range(n_rclass)]
+
+    files = dict((name, os.path.join(folder, name)) for name in ["compound", "reaction", "enzyme", "rclass",
+                                                                  "pathway.list"])
+    files["kgml"] = os.path.join(folder, "kgml", "ko")
+
+    with open(files["compound"], "w") as f:
+        for i in range(n_compounds):
+            f.write("ENTRY       {c:<28}Compound\n".format(c=compound(i)))
+            f.write("NAME        Compound {i};\n            Synonym {i}\n".format(i=i + 1))
+            f.write("FORMULA     C{c}H{h}O{o}\n".format(c=rng.randint(1, 40), h=rng.randint(1, 80),
+                                                      o=rng.randint(0, 20)))
+            f.write("EXACT_MASS  {m:.4f}\n".format(m=rng.uniform(10, 1500)))
+            for j, p in enumerate(rng.sample(pathways, min(3, len(pathways)))):
+                f.write("{k:<12}map{p}  Pathway {p}\n".format(k="PATHWAY" if j == 0 else "", p=p))
+            f.write("///\n")
+
+    with open(files["enzyme"], "w") as f:
+        for i in range(n_enzymes):
+            f.write("ENTRY       EC {e:<25}Enzyme\n".format(e=enzyme(i)))
+            f.write("NAME        enzyme {i};\n            alternative name\n".format(i=i + 1))
+            for j, p in enumerate(rng.sample(pathways, min(2, len(pathways)))):
+                f.write("{k:<12}ec{p}  Pathway {p}\n".format(k="PATHWAY" if j == 0 else "", p=p))
+            f.write("///\n")
+
+    with open(files["rclass"], "w") as f:
+        for i, (c1, c2) in enumerate(rpairs):
+            f.write("ENTRY       RC{i:05d}                     RClass\n".format(i=i + 1))
+            f.write("DEFINITION  C1a-C1b:*-*:C2a-C2b\n            N1a-C1a:*-*:N1b-C1b\n")
+            f.write("RPAIR       {c1}_{c2}\n".format(c1=c1, c2=c2))
+            f.write("PATHWAY     rn{p}  Pathway {p}\n".format(p=rng.choice(pathways)))
+            f.write("///\n")
+
+    with open(files["reaction"], "w") as f:
+        for i in range(n_reactions):
+            f.write("ENTRY       R{i:05d}                      Reaction\n".format(i=i + 1))
+            f.write("NAME        reaction {i}\n".format(i=i + 1))
+            classes = [rng.randrange(n_rclass) for _ in range(rng.randint(1, 3))]
+            c1, c2 = rpairs[classes[0]]
+            f.write("DEFINITION  {c1} <=> {c2}\nEQUATION    {c1} <=> {c2}\n".format(c1=c1, c2=c2))
+            for j, rc in enumerate(classes):
+                f.write("{k:<12}RC{rc:05d}  {c1}_{c2}\n".format(k="RCLASS" if j == 0 else "", rc=rc + 1,
+                                                              c1=rpairs[rc][0], c2=rpairs[rc][1]))
+            f.write("ENZYME      {e}\n".format(e=enzyme(rng.randrange(n_enzymes))))
+            f.write("///\n")
+
+    with open(files["pathway.list"], "w") as f:
+        for i, p in enumerate(pathways):
+            if i == 0:
+                f.write("#Metabolism\n")
+            if i % 10 == 0:
+                f.write("##Category {c}\n".format(c=i // 10 + 1))
+            f.write("{p}\tPathway {p}\n".format(p=p))
+
+    for p in pathways[0:n_kgml]:
+        with open(os.path.join(files["kgml"], "ko{p}.xml".format(p=p)), "w") as f:
+            f.write('<?xml version="1.0"?>\n')
+            f.write('<pathway name="path:ko{p}" org="ko" number="{p}" title="Pathway {p}">\n'.format(p=p))
+            for i in range(max(1, n_reactions // n_pathways)):
+                r = rng.randrange(n_reactions)
+                c1, c2 = rpairs[rng.randrange(n_rclass)]
+                f.write('    <reaction id="{i}" name="rn:R{r:05d}" type="{t}">\n'
+                        '        <substrate id="{i}1" name="cpd:{c1}"/>\n'
+                        '        <product id="{i}2" name="cpd:{c2}"/>\n'
+                        '    </reaction>\n'.format(i=i + 1, r=r + 1, c1=c1, c2=c2,
+                                                   t=rng.choice(["reversible", "irreversible"])))
+            f.write('</pathway>\n')
+    return files
+
+
+# Stand-in for a py2neo Graph which records the statements it is sent instead of executing them
+class RecordingGraph:
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def delete_all(self):
+        self.statements += 1
+
+    def run(self, statement, parameters=None, **kwparameters):
+        self.statements += 1
+        self.bytes += len(statement)
+        if parameters:
+            self.rows += len(parameters.get("rows", []))
+            self.bytes += len(json.dumps(parameters))
+        return []
+
+    def data(self, statement, parameters=None, **kwparameters):
+        self.run(statement, parameters)
+        # answer as the 3.x servers py2neo v3 connects to, with every index online
+        if statement.startswith("CALL dbms.components"):
+            return [{"name": "Neo4j Kernel", "versions": ["3.5.35"]}]
+        if statement.startswith("CALL db.indexes"):
+            return [{"description": "INDEX ON :{l}({p})".format(l=label, p=prop), "state": "ONLINE"}
+                    for kind in ["constraints", "node_indexes"] for _, label, prop in createDB.SCHEMA[kind]]
+        return []
+
+
+def measure(function, *args):
+    # Run a function in a fresh worker process, returning its result size, wall time and peak RSS
+    # The worker is spawned rather than forked, as a forked child starts with the memory of this process
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(measure_in_process, function, *args).result()
+
+
+def measure_in_process(function, *args):
+    start_peak = createDB.peak_rss(children=True)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start_time
+    return {"records": len(result), "seconds": elapsed, "peak_rss_bytes": worker_peak_rss(start_peak)}
+
+
+def worker_peak_rss(start_peak):
+    # Peak RSS in bytes of this worker and its finished child processes, or None where it cannot be measured
+    # ru_maxrss of a spawned worker starts from the peak of the process that started it, so on Linux the worker's own
+    # peak is read from VmHWM, which starts afresh at exec.  Elsewhere the growth of ru_maxrss during the call is used
+    if start_peak is None:
+        return None
+    try:
+        with open("/proc/self/status") as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        return createDB.peak_rss(children=True) - start_peak
+    # kilobytes on Linux
+    return max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def parse_and_find_triples(rclass_file):
+    return createDB.find_triples(createDB.kegg_rclass(rclass_file))
+
+
+def benchmark_parsers(files, scale):
+    runs = list()
+    stages = [("kegg_reactions", createDB.kegg_reactions, files["reaction"]),
+              ("kegg_enzymes", createDB.kegg_enzymes, files["enzyme"]),
+              ("kegg_rclass", createDB.kegg_rclass, files["rclass"]),
+              ("kegg_compounds", createDB.kegg_compounds, files["compound"]),
+              ("read_kegg_xml", createDB.read_kegg_xml, files["kgml"]),
+              ("find_triples", parse_and_find_triples, files["rclass"])]
+    for name, function, filename in stages:
+        run = measure(function, filename)
+        run.update({"stage": name, "scale": scale, "records_per_second": run["records"] / run["seconds"]})
+        # peak RSS is not measured on Windows
+        print("  {s:<16} {r:>8} records {t:8.3f} s {rate:12.0f} records/s {m:>8} MB".format(
+            s=name, r=run["records"], t=run["seconds"], rate=run["records_per_second"],
+            m="-" if run["peak_rss_bytes"] is None else "{m:.1f}".format(m=run["peak_rss_bytes"] / 1E6)))
+        runs.append(run)
+    return runs
+
+
+def benchmark_loaders(files, scale):
+    runs = list()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        reactions = createDB.kegg_reactions(files["reaction"])
+        enzymes = createDB.kegg_enzymes(files["enzyme"])
+        rclass = createDB.kegg_rclass(files["rclass"])
+        compounds = createDB.kegg_compounds(files["compound"])
+        triples = createDB.find_triples(rclass)
+        metabolic_reactions = createDB.read_kegg_xml(files["kgml"])
+    loaders = [("create_db_from_reactions", lambda g: createDB.create_db_from_reactions(reactions, g, enzymes,
+                                                                                        compounds, rclass)),
+               ("create_db_from_xml", lambda g: createDB.create_db_from_xml(metabolic_reactions, g, reactions,
+                                                                            enzymes, compounds)),
+               ("create_db_from_triples", lambda g: createDB.create_db_from_triples(triples, rclass, compounds, g)),
+               ("create_db_unified", lambda g: createDB.create_db_unified(g, reactions, metabolic_reactions, triples,
+                                                                          enzymes, compounds, rclass))]
+    for name, loader in loaders:
+        graph = RecordingGraph()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            start_time = time.perf_counter()
+            loader(graph)
+            elapsed = time.perf_counter() - start_time
+        run = {"stage": name, "scale": scale, "seconds": elapsed, "statements": graph.statements,
+               "rows": graph.rows, "bytes": graph.bytes, "statements_per_second": graph.statements / elapsed,
+               "rows_per_second": graph.rows / elapsed, "bytes_per_second": graph.bytes / elapsed}
+        print("  {s:<24} {n:>8} statements {r:>8} rows {t:8.3f} s {b:12.0f} bytes/s".format(
+            s=name, n=graph.statements, r=graph.rows, t=elapsed, b=run["bytes_per_second"]))
+        runs.append(run)
+    return runs
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,269 @@
 #!/usr/bin/python
 
+import os
 import re
+import sys
 import glob
+import gzip
 import time
+import csv
+import json
+import pickle
+import tarfile
+import hashlib
+import mmap
+import cProfile
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import Mapping
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import xml.etree.ElementTree as ET
+try:
+    import resource
+except ImportError:
+    resource = None  # not available on Windows
+try:
+    import pyarrow
+    import pyarrow.dataset
+except ImportError:
+    pyarrow = None  # optional, only needed for columnar export
+import numpy as np
 from py2neo import authenticate, Graph
 from pandas import DataFrame
 
 
 def main():
+    # Input and output locations, from a JSON file named on the command line or by KEGG_CONFIG
+    config = read_config(sys.argv[1] if len(sys.argv) > 1 else None)
+
     # Connect to neo4j
     authenticate("localhost:7474", "neo4j", "neo4jpw")
     graph = Graph("localhost:7474/db/data/")
 
-    pathway_list = read_pathway_list("C:/Databases/KEGG/pathway.list")
-    main_pathway = "Metabolism"
-    use_pathways = [i[2] for i in pathway_list if i[0] in main_pathway]
-    use_pathways.remove('01100')
+    with METRICS.stage("build"):
+        pathway_list = read_pathway_list(config["pathway_list"])
+        use_pathways = select_pathways(pathway_list, categories=["Metabolism"])
+        # Level 1 or level 2 categories or pathway numbers to build a partial database from, or None for everything
+        # e.g. scope = ["Carbohydrate metabolism"]
+        scope = None
+
+        # Read in files concurrently and create a new database
+        data = parse_kegg_files(config["reaction"], config["enzyme"], config["rclass"], config["compound"],
+                                kgml_folder=config["kgml"], use_pathways=use_pathways, cache_dir=config["cache_dir"])
+        if scope is not None:
+            data = pathway_scope(data, select_pathways(pathway_list, categories=scope, pathways=scope))
+        metabolic_reactions = data['metabolic_reactions']
+        reactions = data['reactions']
+        enzymes = data['enzymes']
+        rclass = data['rclass']
+        compounds = data['compounds']
+        triples = data['triples']
 
-    metabolic_reactions = read_kegg_xml("C:/Databases/KEGG/kgml/ko", use_pathways=use_pathways)
+        # Create a new database using rclass triples
+        # create_db_from_triples(triples, rclass, compounds, graph)
 
-    # Read in files and create a new database
-    reactions = kegg_reactions("C:/Databases/KEGG/reaction/reaction")
-    enzymes = kegg_enzymes("C:/Databases/KEGG/enzyme/enzyme")
-    rclass = kegg_rclass("C:/Databases/KEGG/rclass/rclass")
-    compounds = kegg_compounds("C:/Databases/KEGG/compound/compound")
-    triples = find_triples(rclass)
+        # Create a new database using metabolic reactions parsed from xml files
+        # create_db_from_xml(metabolic_reactions, graph, reactions, enzymes, compounds)
 
-    # Create a new database using rclass triples
-    # create_db_from_triples(triples, rclass, compounds, graph)
+        # Create a new database holding all three models, each relationship tagged with its model
+        # create_db_unified(graph, reactions, metabolic_reactions, triples, enzymes, compounds, rclass)
 
-    # Create a new database using metabolic reactions parsed from xml files
-    # create_db_from_xml(metabolic_reactions, graph, reactions, enzymes, compounds)
+        # Create a new database using reactions
+        create_db_from_reactions(reactions, graph, enzymes, compounds, rclass)
 
-    # Create a new database using reactions
-    create_db_from_reactions(reactions, graph, enzymes, compounds, rclass)
+        # Test database
+        test_database(graph)
 
-    # Test database
-    test_database(graph)
+    # Write build metrics for monitoring
+    METRICS.write_json(os.path.join(config["metrics_dir"], "build_metrics.json"))
+    METRICS.write_prometheus(os.path.join(config["metrics_dir"], "build_metrics.prom"))
 
     return 0
 
 
+# Input and output locations of a build.  Values may refer to the KEGG release folder as {kegg_dir}
+# Any input file may be gzipped (name.gz) or a member of a tar archive, written as archive.tar.gz!path/in/archive,
+# and the kgml folder may be a folder within an archive.  Compressed inputs are decompressed as they are parsed
+# There is no default KEGG release folder: kegg_dir is given in a config file or by KEGG_DIR
+DEFAULT_CONFIG = {"pathway_list": "{kegg_dir}/pathway.list",
+                  "reaction": "{kegg_dir}/reaction/reaction",
+                  "enzyme": "{kegg_dir}/enzyme/enzyme",
+                  "rclass": "{kegg_dir}/rclass/rclass",
+                  "compound": "{kegg_dir}/compound/compound",
+                  "kgml": "{kegg_dir}/kgml/ko",
+                  "cache_dir": "{kegg_dir}/cache",
+                  "metrics_dir": "{kegg_dir}"}
+
+
+def read_config(filename=None):
+    # DEFAULT_CONFIG updated from a JSON file (filename, or the KEGG_CONFIG environment variable) and KEGG_DIR
+    config = dict(DEFAULT_CONFIG)
+    filename = filename or os.environ.get("KEGG_CONFIG")
+    if filename:
+        with open(filename) as f:
+            config.update(json.load(f))
+    if "KEGG_DIR" in os.environ:
+        config["kegg_dir"] = os.environ["KEGG_DIR"]
+    if "kegg_dir" not in config and any(isinstance(v, str) and "{kegg_dir}" in v for v in config.values()):
+        raise ValueError("No KEGG release folder: set KEGG_DIR, or give kegg_dir in a config file "
+                         "(the first argument or KEGG_CONFIG)")
+    return dict((k, v.format(kegg_dir=config.get("kegg_dir")) if isinstance(v, str) else v)
+                for k, v in config.items())
+
+
+# Separates an archive from the path of a file or folder inside it
+ARCHIVE_SEPARATOR = "!"
+
+
+def split_archive_path(filename):
+    # (archive, member) for a path inside an archive, otherwise (None, filename)
+    if ARCHIVE_SEPARATOR in filename:
+        archive, member = filename.split(ARCHIVE_SEPARATOR, 1)
+        return archive, member.strip("/")
+    return None, filename
+
+
+def compressed_input(filename):
+    # Compressed inputs are read as streams, so they cannot be split into chunks, indexed or seeked
+    return split_archive_path(filename)[0] is not None or filename.endswith(".gz")
+
+
+def member_name(info):
+    name = info.name
+    return name[2:] if name.startswith("./") else name
+
+
+@contextmanager
+def open_kegg_file(filename):
+    # Open a plain, gzipped or archived text file for streaming
+    # Archives are read in a single forward pass, stopping at the member, so nothing is unpacked to disk
+    archive, member = split_archive_path(filename)
+    if archive is not None:
+        with tarfile.open(archive, "r|*") as tar:
+            for info in tar:
+                if info.isfile() and member_name(info) == member:
+                    # members of a streamed archive are not seekable, which TextIOWrapper requires
+                    yield (line.decode() for line in tar.extractfile(info))
+                    return
+        raise FileNotFoundError(member + " not found in " + archive)
+    elif filename.endswith(".gz"):
+        with gzip.open(filename, "rt") as f:
+            yield f
+    else:
+        with open(filename, "r") as f:
+            yield f
+
+
+# Per-stage wall time, CPU time, record and statement counts, throughput and peak memory for the build pipeline
+# Stages are recorded with "with METRICS.stage(name) as stage:", setting stage['records'] and stage['statements']
+# inside the block.  Stages named in profile (or all stages if profile is True) are also run under cProfile, with
+# the statistics written to profile_dir
+# Peak memory is the high-water mark of the largest of the build process and its finished child processes, where
+# the parsers run; peak_rss_growth_bytes is the amount by which a stage raised it
+class Metrics:
+    def __init__(self, profile=None, profile_dir="."):
+        self.stages = list()
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.profiling = False
+        self.depth = 0
+
+    @contextmanager
+    def stage(self, name):
+        stage = {"stage": name, "depth": self.depth, "records": 0, "statements": 0}
+        profiler = None
+        if not self.profiling and (self.profile is True or (self.profile and name in self.profile)):
+            profiler = cProfile.Profile()
+            self.profiling = True
+            profiler.enable()
+        self.depth += 1
+        start_wall = time.perf_counter()
+        start_cpu = cpu_time()
+        start_rss = peak_rss(children=True)
+        try:
+            yield stage
+        finally:
+            stage["wall_seconds"] = time.perf_counter() - start_wall
+            stage["cpu_seconds"] = cpu_time() - start_cpu
+            self.depth -= 1
+            if profiler is not None:
+                profiler.disable()
+                self.profiling = False
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, name + ".prof"))
+            stage["records_per_second"] = stage["records"] / stage["wall_seconds"] if stage["wall_seconds"] else 0
+            stage["statements_per_second"] = \
+                stage["statements"] / stage["wall_seconds"] if stage["wall_seconds"] else 0
+            stage["peak_rss_bytes"] = peak_rss(children=True)
+            stage["peak_rss_growth_bytes"] = stage["peak_rss_bytes"] - start_rss if start_rss is not None else None
+            self.stages.append(stage)
+            print("Time to {name} = {t:.2f} seconds".format(name=name.replace("_", " "), t=stage["wall_seconds"]))
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"time": time.time(), "stages": self.stages}, f, indent=2)
+
+    # Prometheus text exposition format, e.g. for the node exporter textfile collector
+    def write_prometheus(self, filename, prefix="kegg_build"):
+        metrics = [("wall_seconds", "Wall clock time of the stage"),
+                   ("cpu_seconds", "CPU time of the stage including child processes"),
+                   ("records", "Records processed by the stage"),
+                   ("statements", "Statements sent by the stage"),
+                   ("records_per_second", "Records processed per second"),
+                   ("peak_rss_bytes", "Peak resident memory so far of the largest of the build process and its "
+                                      "finished child processes, max of RUSAGE_SELF and RUSAGE_CHILDREN, at the end "
+                                      "of the stage"),
+                   ("peak_rss_growth_bytes", "Increase in peak_rss_bytes during the stage")]
+        # stages run more than once are summed, keeping the highest peak memory
+        totals = dict()
+        for stage in self.stages:
+            total = totals.setdefault(stage["stage"], {"wall_seconds": 0, "cpu_seconds": 0, "records": 0,
+                                                       "statements": 0, "peak_rss_bytes": stage["peak_rss_bytes"],
+                                                       "peak_rss_growth_bytes": stage["peak_rss_growth_bytes"]})
+            for metric in ["wall_seconds", "cpu_seconds", "records", "statements"]:
+                total[metric] += stage[metric]
+            for metric in ["peak_rss_bytes", "peak_rss_growth_bytes"]:
+                if stage[metric] is not None:
+                    total[metric] = max(total[metric], stage[metric])
+        for total in totals.values():
+            total["records_per_second"] = total["records"] / total["wall_seconds"] if total["wall_seconds"] else 0
+        with open(filename + ".tmp", "w") as f:
+            for metric, description in metrics:
+                f.write("# HELP {p}_{m} {d}\n# TYPE {p}_{m} gauge\n".format(p=prefix, m=metric, d=description))
+                for name, total in totals.items():
+                    if total[metric] is not None:
+                        f.write("{p}_{m}{{stage=\"{s}\"}} {v}\n".format(p=prefix, m=metric, s=name, v=total[metric]))
+        os.replace(filename + ".tmp", filename)
+
+
+def cpu_time():
+    # User and system time of this process and any finished child processes
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def peak_rss(children=False):
+    # Peak resident set size of this process in bytes, or None where it cannot be measured
+    # With children, the larger of that and the peak of the largest finished child process, as cpu_time counts them
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+METRICS = Metrics()
+
+
 def read_pathway_list(filename):
     # Read in pathway list and return a hierarchy
     pathways = list()
     level_1_heading = ""
     level_2_heading = ""
-    with open(filename) as f:
+    with open_kegg_file(filename) as f:
         for line in f:
             if line[0:1] == "#":
                 if line[0:2] == "##":
@@ -60,341 +276,1591 @@ def read_pathway_list(filename):
     return pathways
 
 
-def read_kegg_xml(folder, use_pathways=None, ignore_pathways=None):
-    # Read in and parse xml files
-    xml_files = glob.glob(folder + '/*.xml')
+def select_pathways(pathway_list, categories=None, pathways=None, ignore_pathways=("01100",)):
+    # Pathway numbers from read_pathway_list under any of the level 1 or level 2 categories or in pathways
+    # The global metabolism map 01100 covers every metabolic pathway and is ignored by default
+    categories = set(categories or [])
+    pathways = set(pathways or [])
+    ignore_pathways = set(ignore_pathways or [])
+    selected = [p[2] for p in pathway_list if p[0] in categories or p[1] in categories or p[2] in pathways]
+    return [p for p in selected if p not in ignore_pathways]
+
+
+def pathway_number(pathway_id):
+    # 5 digit pathway number of a pathway id such as map00010, ec00010, rn00010 or 00010
+    number = re.search(r"(\d{5})", pathway_id or "")
+    return number.group(1) if number else None
+
+
+def kgml_files(folder, use_pathways=None, ignore_pathways=None):
+    # List the kgml files in a folder, keeping or dropping pathways by the 5 digit pathway number in the file name
+    xml_files = sorted(glob.glob(folder + '/*.xml'))
     if type(use_pathways) == list:
-        r = re.compile("|".join(use_pathways))
-        l_keepme = map(lambda x: len(r.findall(x)) > 0, xml_files)
-        keep_me = [i for i, x in enumerate(list(l_keepme)) if x]
-        xml_files = [xml_files[i] for i in keep_me]
+        keep = set(use_pathways)
+        xml_files = [f for f in xml_files if kgml_pathway_number(f) in keep]
     elif type(ignore_pathways) == list:
-        r = re.compile("|".join(ignore_pathways))
-        l_keepme = map(lambda x: len(r.findall(x)) > 0, xml_files)
-        keep_me = [i for i, x in enumerate(list(l_keepme)) if not x]
-        xml_files = [xml_files[i] for i in keep_me]
+        drop = set(ignore_pathways)
+        xml_files = [f for f in xml_files if kgml_pathway_number(f) not in drop]
+    return xml_files
+
+
+def kgml_pathway_number(filename):
+    number = re.search(r"(\d{5})\.xml$", filename)
+    return number.group(1) if number else None
+
+
+def kgml_compound(name):
+    # First KEGG id of a substrate or product name attribute, e.g. cpd:C00031 or gl:G00001
+    if name[0:3] == "gl:":
+        return name[3:9]  # glycan
+    return name[4:10]
 
+
+def read_kgml_file(filename):
+    # Stream a single kgml file (a file name or a binary file object), returning its reactions
+    # Every substrate and product is kept as an (id, name) tuple.  Elements are cleared once read
     reactions = list()
-    for filename in xml_files:
-        tree = ET.parse(filename).getroot()
-        pathway_number = tree.attrib['number']
-        pathway_name = tree.attrib['title']
-        reactions_xml = tree.findall("reaction")
-        for r in reactions_xml:
+    pathway_number = None
+    pathway_name = None
+    substrates = list()
+    products = list()
+    for event, element in ET.iterparse(filename, events=("start", "end")):
+        if event == "start":
+            if element.tag == "pathway":
+                pathway_number = element.attrib['number']
+                pathway_name = element.attrib['title']
+            continue
+        if element.tag == "substrate":
+            substrates.append((element.attrib['id'], kgml_compound(element.attrib['name'])))
+        elif element.tag == "product":
+            products.append((element.attrib['id'], kgml_compound(element.attrib['name'])))
+        elif element.tag == "reaction":
             reaction = dict()
-            reaction['id'] = r.attrib['id']
-            reaction['name'] = [x[3:] for x in r.attrib['name'].split(" ")]
-            reaction['type'] = r.attrib['type']
+            reaction['id'] = element.attrib['id']
+            reaction['name'] = [x[3:] for x in element.attrib['name'].split(" ")]
+            reaction['type'] = element.attrib['type']
             reaction['pathway_id'] = pathway_number
             reaction['pathway_name'] = pathway_name
-            for child in r:
-                # Currently takes just a single substrate or product when multiple are present
-                cpd = dict()
-                cpd['id'] = child.attrib['id']
-                if child.attrib['name'][0:2] == "g1":
-                    cpd['name'] = child.attrib['name'][3:9]  # glycan
-                else:
-                    cpd['name'] = child.attrib['name'][4:10]  # limit attribute to 6 characters (only first cpd entry)
-                reaction[child.tag] = cpd
+            reaction['substrates'] = tuple(substrates)
+            reaction['products'] = tuple(products)
             reactions.append(reaction)
+            substrates = list()
+            products = list()
+        if element.tag != "pathway":
+            element.clear()
+    return reactions
+
+
+def read_kegg_xml(folder, use_pathways=None, ignore_pathways=None, processes=None):
+    # Read in and parse xml files, spread over worker processes
+    # A folder within an archive is read in a single pass instead (see read_kgml_archive)
+    reactions = list()
+    with METRICS.stage("read_kgml") as stage:
+        if split_archive_path(folder)[0] is not None:
+            reactions = read_kgml_archive(folder, use_pathways, ignore_pathways)
+        else:
+            xml_files = kgml_files(folder, use_pathways, ignore_pathways)
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                for file_reactions in executor.map(read_kgml_file, xml_files, chunksize=16):
+                    reactions.extend(file_reactions)
+        stage['records'] = len(reactions)
     return reactions
 
 
+def read_kgml_archive(folder, use_pathways=None, ignore_pathways=None):
+    # Stream the kgml files of a folder within a tar archive, parsing each member as it is reached
+    # Pathways are kept or dropped by number as in kgml_files.  Members are read in archive order
+    archive, member = split_archive_path(folder)
+    return read_kegg_archive(archive, dict(), member, use_pathways, ignore_pathways)[1]
+
+
+def read_kegg_archive(archive, parsers, kgml_member=None, use_pathways=None, ignore_pathways=None):
+    # Parse several inputs held in one tar archive in a single streaming pass
+    # parsers maps the path of each flat file in the archive to its parse_record function, and kgml_member is an
+    # optional kgml folder in the archive, read as in read_kgml_archive
+    # Returns a dictionary of the records of each flat file, by path, and the kgml reactions
+    keep = set(use_pathways) if type(use_pathways) == list else None
+    drop = set(ignore_pathways) if type(ignore_pathways) == list else set()
+    data = dict()
+    reactions = list()
+    with tarfile.open(archive, "r|*") as tar:
+        for info in tar:
+            name = member_name(info)
+            if not info.isfile():
+                continue
+            if name in parsers:
+                records = dict()
+                for fields in kegg_records(line.decode() for line in tar.extractfile(info)):
+                    record = parsers[name](fields)
+                    if record is not None:
+                        records[record['entry']] = record
+                data[name] = records
+            elif kgml_member is not None and os.path.dirname(name) == kgml_member and name.endswith(".xml"):
+                number = kgml_pathway_number(name)
+                if (keep is not None and number not in keep) or (keep is None and number in drop):
+                    continue
+                reactions.extend(read_kgml_file(tar.extractfile(info)))
+    for name in parsers:
+        if name not in data:
+            raise FileNotFoundError(name + " not found in " + archive)
+    return data, reactions
+
+
+def kegg_records(lines):
+    # Stream KEGG flat file records one at a time from an iterable of lines
+    # Each record is yielded as a dictionary mapping field name (e.g. ENTRY, PATHWAY) to a list of the text found
+    # from column 12 onwards, with continuation lines appended to the field above them
+    record = dict()
+    field = None
+    for line in lines:
+        if line[0:3] == "///":
+            if record:
+                yield record
+            record = dict()
+            field = None
+            continue
+        line = line.rstrip("\n")
+        key = line[0:12].strip()
+        if key:
+            field = key
+            record.setdefault(field, []).append(line[12:])
+        elif field is not None:
+            record[field].append(line[12:])
+    # Final record without a terminating ///
+    if record:
+        yield record
+
+
+def name_field(fields):
+    # First line of a NAME field, with the trailing separator removed
+    name_text = fields["NAME"][0].rstrip()
+    if name_text[-1:] == ";":
+        return name_text[:-1]
+    return name_text
+
+
+def parse_reaction_record(fields):
+    # Convert a reaction record into a dictionary.  Records without an RCLASS are ignored
+    if "ENTRY" not in fields or "RCLASS" not in fields:
+        return None
+    record = dict()
+    # Entry token
+    record["entry"] = fields["ENTRY"][0][0:6]
+    # RClass token
+    record['rclass'] = [re.findall("([RC0-9]+)", line) for line in fields["RCLASS"]]
+    # Name token
+    if "NAME" in fields:
+        record['name'] = fields["NAME"][0].strip()
+    # Definition token
+    if "DEFINITION" in fields:
+        record['definition'] = fields["DEFINITION"][0].strip()
+    # Equation token
+    if "EQUATION" in fields:
+        record['equation'] = fields["EQUATION"][0].strip()
+    # Enzyme token
+    if "ENZYME" in fields:
+        record['enzyme'] = fields["ENZYME"][0].strip()
+    return record
+
+
+def parse_enzyme_record(fields):
+    # Convert an enzyme record into a dictionary.  Records without a numeric EC number are ignored
+    if "ENTRY" not in fields:
+        return None
+    entry_id = re.search(r"EC \d+.\d+.\d+.\d+", fields["ENTRY"][0])
+    if not entry_id:
+        return None
+    record = dict()
+    record["entry"] = entry_id.group()
+    # Name token
+    if "NAME" in fields:
+        record['name'] = name_field(fields)
+    # Pathway token
+    if "PATHWAY" in fields:
+        record['pathway'] = [line[0:7] for line in fields["PATHWAY"]]
+    return record
+
+
+def parse_rclass_record(fields):
+    # Convert a reaction class record into a dictionary
+    if "ENTRY" not in fields:
+        return None
+    record = dict()
+    record["entry"] = fields["ENTRY"][0][0:7]
+    if "DEFINITION" in fields:
+        record['definition'] = [line.rstrip() for line in fields["DEFINITION"]]
+    if "RPAIR" in fields:
+        v_rpair = []
+        for line in fields["RPAIR"]:
+            v_rpair.extend(re.findall("([C0-9_]+)", line))
+        record['rpairs'] = v_rpair
+    if "PATHWAY" in fields:
+        record['pathway'] = [line[0:8] for line in fields["PATHWAY"]]
+    return record
+
+
+def parse_compound_record(fields):
+    # Convert a compound record into a dictionary
+    if "ENTRY" not in fields:
+        return None
+    record = dict()
+    record["entry"] = fields["ENTRY"][0][0:6]
+    # Name token
+    if "NAME" in fields:
+        record['name'] = name_field(fields)
+    # Formula token
+    if "FORMULA" in fields:
+        record['formula'] = fields["FORMULA"][0].rstrip()
+    # Exact mass token
+    if "EXACT_MASS" in fields:
+        mass_text = re.search("[0-9.]+", fields["EXACT_MASS"][0])
+        if mass_text:
+            record['mass'] = float(mass_text.group(0))
+    # Pathways token
+    if "PATHWAY" in fields:
+        record['pathway'] = [line[0:8] for line in fields["PATHWAY"]]
+    return record
+
+
+def parse_kegg_file(filename, parse_record):
+    # Stream a KEGG flat file, converting each record with parse_record and indexing the results by entry
+    data = dict()
+    with open_kegg_file(filename) as f:
+        for fields in kegg_records(f):
+            record = parse_record(fields)
+            if record is not None:
+                data[record['entry']] = record
+    return data
+
+
 def kegg_reactions(filename):
-    # Read in reactions file
-    file = open(filename, "r")
+    # Read in and parse reactions file
     print("Reading Reaction File")
-    reactions = file.readlines()
-    file.close()
-
-    # Find end of each record
-    end_list = []
-    for line_i, line in enumerate(reactions, 1):
-        if re.match("///", line):
-            end_list.append(line_i)
-
-    # Loop through each record extracting tokens
-    print("Parsing Reaction Class Data")
-    count2 = 0
-    reaction_data = dict()
-    for ref in range(0, len(end_list)-1):
-        count1 = count2
-        count2 = end_list[ref]
-        r = reactions[count1:count2]
-        token_list = ["ENTR", "NAME", "DEFI", "EQUA", "RCLA", "ENZY"]
-        tokens = dict()
-
-        for line_i, line in enumerate(r, 1):
-            if line[0:4] in token_list:
-                tokens[line[0:4]] = line_i - 1
-        # Parse tokens, extracting information into a dictionary
-        if "ENTR" in tokens.keys() and "RCLA" in tokens.keys():
-            record = dict()
-            # Entry token
-            record["entry"] = r[tokens["ENTR"]][12:18]
-            # RClass token
-            found_end = False
-            count = 0
-            v_rclass = []
-            while not found_end:
-                current_line = r[tokens["RCLA"] + count]
-                if current_line[0:4] in ["RCLA", "    "]:
-                    v_rclass.append(re.findall("([RC0-9]+)", current_line[12:]))
-                    count += 1
-                else:
-                    found_end = True
-                record['rclass'] = v_rclass
-            # Name token
-            if "NAME" in tokens.keys():
-                record['name'] = r[tokens["NAME"]][12:].strip()
-            # Definition token
-            if "DEFI" in tokens.keys():
-                record['definition'] = r[tokens["DEFI"]][12:].strip()
-            # Equation token
-            if "EQUA" in tokens.keys():
-                record['equation'] = r[tokens["EQUA"]][12:].strip()
-            # Enzyme token
-            if "ENZY" in tokens.keys():
-                record['enzyme'] = r[tokens["ENZY"]][12:].strip()
-            # Add record to list
-            reaction_data[record['entry']] = record
+    with METRICS.stage("read_reactions") as stage:
+        reaction_data = parse_kegg_file(filename, parse_reaction_record)
+        stage['records'] = len(reaction_data)
     print(len(reaction_data), "reaction records created\n")
     return reaction_data
 
 
 def kegg_enzymes(filename):
-    # Read in enzyme file
-    file = open(filename, "r")
+    # Read in and parse enzyme file
     print("Reading Enzyme File")
-    enzymes = file.readlines()
-    file.close()
-
-    # Find end of each record
-    end_list = []
-    for line_i, line in enumerate(enzymes, 1):
-        if re.match("///", line):
-            end_list.append(line_i)
-
-    # Loop through each record extracting tokens
-    print("Parsing Enzyme Data")
-    count2 = 0
-    enzyme_data = dict()
-    for ref in range(0, len(end_list)-1):
-        count1 = count2
-        count2 = end_list[ref]
-        e = enzymes[count1:count2]
-        token_list = ["ENTR", "NAME", "PATH"]
-        tokens = dict()
-
-        for line_i, line in enumerate(e, 1):
-            if line[0:4] in token_list:
-                tokens[line[0:4]] = line_i - 1
-        # Parse tokens, extracting information into a dictionary
-        if "ENTR" in tokens.keys():
-            record = dict()
-            entry_id = re.search("EC \d+.\d+.\d+.\d+", e[tokens["ENTR"]])
-            if entry_id:
-                record["entry"] = entry_id.group()
-            else:
-                break
-            # Name token
-            if "NAME" in tokens.keys():
-                name_text = e[tokens["NAME"]].rstrip()
-                if name_text[len(name_text) - 1] == ";":
-                    record['name'] = name_text[12:len(name_text) - 1]
-                else:
-                    record['name'] = name_text[12:]
-            # Pathway token
-            if "PATH" in tokens.keys():
-                found_end = False
-                count = 0
-                v_pathway = []
-                while not found_end:
-                    current_line = e[tokens["PATH"] + count]
-                    if current_line[0:4] in ["PATH", "    "]:
-                        v_pathway.append(current_line[12:19])
-                        count += 1
-                    else:
-                        found_end = True
-                record['pathway'] = v_pathway
-            # Add record to list
-            enzyme_data[record['entry']] = record
+    with METRICS.stage("read_enzymes") as stage:
+        enzyme_data = parse_kegg_file(filename, parse_enzyme_record)
+        stage['records'] = len(enzyme_data)
     print(len(enzyme_data), "enzyme records created\n")
     return enzyme_data
 
 
 def kegg_rclass(filename):
-    # Read in rclass file
-    file = open(filename, "r")
+    # Read in and parse rclass file
     print("Reading Reaction Class File")
-    rclass = file.readlines()
-    file.close()
-
-    # Find end of each record
-    end_list = []
-    for line_i, line in enumerate(rclass, 1):
-        if re.match("///", line):
-            end_list.append(line_i)
-
-    # Loop through each record extracting tokens
-    print("Parsing Reaction Class Data")
-    count2 = 0
-    rclass_data = dict()
-    for ref in range(0, len(end_list)-1):
-        count1 = count2
-        count2 = end_list[ref]
-        r = rclass[count1:count2]
-        token_list = ["ENTR", "DEFI", "RPAI", "PATH"]
-        tokens = dict()
-        for line_i, line in enumerate(r, 1):
-            if line[0:4] in token_list:
-                tokens[line[0:4]] = line_i - 1
-        # Parse tokens, extracting information into a dictionary
-        if "ENTR" in tokens.keys():
-            record = dict()
-            record["entry"] = r[tokens["ENTR"]][12:19]
-            if "DEFI" in tokens.keys():
-                found_end = False
-                count = 0
-                v_definition = []
-                while not found_end:
-                    current_line = r[tokens["DEFI"] + count]
-                    if current_line[0:4] in ["DEFI", "    "]:
-                        v_definition.append(current_line[12:].rstrip())
-                        count += 1
-                    else:
-                        found_end = True
-                record['definition'] = v_definition
-            if "RPAI" in tokens.keys():
-                found_end = False
-                count = 0
-                v_rpair = []
-                while not found_end:
-                    current_line = r[tokens["RPAI"] + count]
-                    if current_line[0:4] in ["RPAI", "    "]:
-                        v_rpair.extend(re.findall("([C0-9_]+)", current_line[12:]))
-                        count += 1
-                    else:
-                        found_end = True
-                record['rpairs'] = v_rpair
-            if "PATH" in tokens.keys():
-                found_end = False
-                count = 0
-                v_pathway = []
-                while not found_end:
-                    current_line = r[tokens["PATH"] + count]
-                    if current_line[0:4] in ["PATH", "    "]:
-                        v_pathway.append(current_line[12:20])
-                        count += 1
-                    else:
-                        found_end = True
-                record['pathway'] = v_pathway
-            # Add record to list
-            rclass_data[record['entry']] = record
+    with METRICS.stage("read_rclass") as stage:
+        rclass_data = parse_kegg_file(filename, parse_rclass_record)
+        stage['records'] = len(rclass_data)
     print(len(rclass_data), "reaction class records created\n")
     return rclass_data
 
 
 def kegg_compounds(filename):
-    # Read in compound file
-    file = open(filename, "r")
+    # Read in and parse compound file
     print("Reading Compound File")
-    compound = file.readlines()
-    file.close()
-
-    # Find end of each record
-    end_list = []
-    for line_i, line in enumerate(compound, 1):
-        if re.match("///", line):
-            end_list.append(line_i)
-
-    # Loop through each record extracting tokens
-    print("Parsing Compound Data")
-    count2 = 0
-    compound_data = dict()
-    for ref in range(0, len(end_list)-1):
-        count1 = count2
-        count2 = end_list[ref]
-        c = compound[count1:count2]
-        token_list = ["ENTR", "NAME", "FORM", "EXAC", "PATH"]
-        tokens = dict()
-        for line_i, line in enumerate(c, 1):
-            if line[0:4] in token_list:
-                tokens[line[0:4]] = line_i - 1
-        # Parse tokens, extracting information into a dictionary
-        if "ENTR" in tokens.keys():
-            record = dict()
-            record["entry"] = c[tokens["ENTR"]][12:18]
-            # Name token
-            if "NAME" in tokens.keys():
-                name_text = c[tokens["NAME"]].rstrip()
-                if name_text[len(name_text) - 1] == ";":
-                    record['name'] = name_text[12:len(name_text) - 1]
-                else:
-                    record['name'] = name_text[12:]
-            # Formula token
-            if "FORM" in tokens.keys():
-                formula_text = c[tokens["FORM"]].rstrip()
-                record['formula'] = formula_text[12:]
-            # Exact mass token
-            if "EXAC" in tokens.keys():
-                mass_text = re.search("[0-9.]+", c[tokens["EXAC"]])
-                if mass_text:
-                    record['mass'] = float(mass_text.group(0))
-            # Pathways token
-            if "PATH" in tokens.keys():
-                found_end = False
-                count = 0
-                v_pathway = []
-                while not found_end:
-                    current_line = c[tokens["PATH"] + count]
-                    if current_line[0:4] in ["PATH", "    "]:
-                        v_pathway.append(current_line[12:20])
-                        count += 1
-                    else:
-                        found_end = True
-                record['pathway'] = v_pathway
-
-            # Add record to list
-            compound_data[record['entry']] = record
+    with METRICS.stage("read_compounds") as stage:
+        compound_data = parse_kegg_file(filename, parse_compound_record)
+        stage['records'] = len(compound_data)
     print(len(compound_data), "compound records created\n")
     return compound_data
 
 
+def kegg_record_offsets(f):
+    # Stream a KEGG flat file opened in binary mode, yielding the byte offset, length and lines of each record
+    start = 0
+    position = 0
+    lines = list()
+    for line in f:
+        position += len(line)
+        lines.append(line)
+        if line[0:3] == b"///":
+            yield start, position - start, lines
+            start = position
+            lines = list()
+    if any(line.strip() for line in lines):
+        yield start, position - start, lines
+
+
+# Random access to the records of a KEGG flat file through a byte offset index and a memory mapped file
+# The index holds the entry, offset and length of every record and is kept in a sidecar file (filename.idx by
+# default) which is rebuilt when the flat file changes.  Records are parsed on demand with the same parse_record
+# functions used by the readers, so the object can be used as a lazy, read-only version of the dictionary returned
+# by kegg_reactions, kegg_enzymes, kegg_rclass or kegg_compounds.  Recently parsed records are cached
+class KeggFileIndex(Mapping):
+    def __init__(self, filename, parse_record, index_file=None, cache_size=4096):
+        if compressed_input(filename):
+            raise ValueError("An offset index needs an uncompressed file: " + filename)
+        self.filename = filename
+        self.parse_record = parse_record
+        self.index_file = index_file if index_file is not None else filename + ".idx"
+        self.offsets = self.read_index()
+        if self.offsets is None:
+            self.offsets = self.build_index()
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) else b""
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def source_stamp(self):
+        stat = os.stat(self.filename)
+        return "#{size}\t{mtime}\n".format(size=stat.st_size, mtime=stat.st_mtime)
+
+    def read_index(self):
+        # Offsets from the sidecar file, or None if it is missing or out of date
+        if not os.path.exists(self.index_file):
+            return None
+        with open(self.index_file) as f:
+            if f.readline() != self.source_stamp():
+                return None
+            offsets = dict()
+            for line in f:
+                entry, offset, length = line.rstrip("\n").split("\t")
+                offsets[entry] = (int(offset), int(length))
+        return offsets
+
+    def build_index(self):
+        print("Indexing", self.filename)
+        offsets = dict()
+        with open(self.filename, "rb") as f:
+            for offset, length, lines in kegg_record_offsets(f):
+                record = self.parse_record(next(kegg_records(line.decode() for line in lines), dict()))
+                if record is not None:
+                    offsets[record['entry']] = (offset, length)
+        with open(self.index_file + ".tmp", "w") as f:
+            f.write(self.source_stamp())
+            for entry, (offset, length) in offsets.items():
+                f.write("{e}\t{o}\t{l}\n".format(e=entry, o=offset, l=length))
+        os.replace(self.index_file + ".tmp", self.index_file)
+        return offsets
+
+    def read_record(self, entry):
+        offset, length = self.offsets[entry]
+        lines = self.map[offset:offset + length].decode().splitlines(True)
+        return self.parse_record(next(kegg_records(lines)))
+
+    def __getitem__(self, entry):
+        if entry in self.cache:
+            self.cache.move_to_end(entry)
+            return self.cache[entry]
+        record = self.read_record(entry)
+        self.cache[entry] = record
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return record
+
+    def __contains__(self, entry):
+        return entry in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # Parse a batch of records, reading them in file order.  Unknown entries are skipped
+    def records(self, entries):
+        found = sorted((e for e in set(entries) if e in self.offsets), key=lambda e: self.offsets[e][0])
+        return dict((entry, self.read_record(entry)) for entry in found)
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+
+def kegg_chunks(filename, n_chunks):
+    # Split a KEGG flat file into at most n_chunks byte ranges (start, end) which begin and end on record boundaries
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, "rb") as f:
+        for i in range(1, n_chunks):
+            position = size * i // n_chunks
+            if position <= bounds[-1]:
+                continue
+            f.seek(position)
+            # skip the partial line and move past the next record terminator
+            f.readline()
+            line = f.readline()
+            while line and line[0:3] != b"///":
+                line = f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i + 1] > bounds[i]]
+
+
+def read_chunk_lines(filename, start, end):
+    # Stream the lines of a file lying between two byte offsets
+    with open(filename, "rb") as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            yield line.decode()
+
+
+def parse_kegg_chunk(filename, parse_record, start, end):
+    # Parse the records lying between two byte offsets of a KEGG flat file
+    data = dict()
+    for fields in kegg_records(read_chunk_lines(filename, start, end)):
+        record = parse_record(fields)
+        if record is not None:
+            data[record['entry']] = record
+    return data
+
+
+def file_fingerprint(filenames, hashes=None):
+    # Identify the current state of a set of source files by path, size, modification time and content hash
+    # Files within an archive are identified by the archive.  hashes memoises the state of each source file by
+    # path, so an archive holding several inputs is only hashed once
+    if hashes is None:
+        hashes = dict()
+    fingerprint = list()
+    for filename in filenames:
+        archive, member = split_archive_path(filename)
+        source = os.path.abspath(archive if archive is not None else filename)
+        if source not in hashes:
+            stat = os.stat(source)
+            sha = hashlib.sha1()
+            with open(source, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+            hashes[source] = (stat.st_size, stat.st_mtime, sha.hexdigest())
+        fingerprint.append((os.path.abspath(filename),) + hashes[source])
+    return fingerprint
+
+
+# Increase when the structure of parsed records changes so that older cache entries are not used
+CACHE_VERSION = 2
+
+
+def cache_filename(cache_dir, name, filenames, args=()):
+    # Each combination of reader, source files and reader arguments owns a single cache file
+    key = repr((CACHE_VERSION, name, sorted(os.path.abspath(f) for f in filenames), args))
+    return os.path.join(cache_dir, "{name}-{key}.pkl.gz".format(name=name,
+                                                                 key=hashlib.sha1(key.encode()).hexdigest()[0:16]))
+
+
+# Parsed data are cached as gzipped pickles holding the source fingerprint followed by the data
+# An entry whose fingerprint no longer matches the source files is stale and is removed.  Each reader keeps only its
+# latest entry, so entries for an earlier file list or reader arguments (e.g. a release adding kgml files, or another
+# pathway selection) are removed when a new one is written
+def read_cache(cache_dir, name, filenames, fingerprint, args=()):
+    path = cache_filename(cache_dir, name, filenames, args)
+    if not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, "rb") as f:
+            if pickle.load(f) == fingerprint:
+                return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    os.remove(path)
+    return None
+
+
+def write_cache(cache_dir, name, filenames, fingerprint, data, args=()):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_filename(cache_dir, name, filenames, args)
+    with gzip.open(path + ".tmp", "wb", compresslevel=3) as f:
+        pickle.dump(fingerprint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    for other in glob.glob(os.path.join(cache_dir, name + "-*.pkl.gz")):
+        if other != path:
+            os.remove(other)
+
+
+# Parse the reaction, enzyme, rclass and compound files (and optionally a folder of kgml files) concurrently
+# Each reader runs in its own process.  Files named in split are additionally cut into chunks at /// boundaries
+# and the chunks are parsed on separate cores.  Inputs within the same archive, including a kgml folder, are parsed
+# together in one pass over the archive (see read_kegg_archive).  If cache_dir is given, results are read from and
+# written to a cache keyed on the source files so unchanged files are not parsed again.  With compact=True the flat
+# file tables are returned as compact records (see KeggRecord).
+# Returns a dictionary of the data returned by the readers together with the rclass triples
+def parse_kegg_files(reaction_file, enzyme_file, rclass_file, compound_file, kgml_folder=None, use_pathways=None,
+                     ignore_pathways=None, processes=None, split=("reactions", "compounds"), chunks=None,
+                     cache_dir=None, compact=False):
+    sources = [("reactions", reaction_file, parse_reaction_record, "reaction"),
+               ("enzymes", enzyme_file, parse_enzyme_record, "enzyme"),
+               ("rclass", rclass_file, parse_rclass_record, "reaction class"),
+               ("compounds", compound_file, parse_compound_record, "compound")]
+    if kgml_folder is not None:
+        xml_archive = split_archive_path(kgml_folder)[0] is not None
+        xml_files = [kgml_folder] if xml_archive else kgml_files(kgml_folder, use_pathways, ignore_pathways)
+        xml_args = (use_pathways, ignore_pathways)
+    if chunks is None:
+        chunks = os.cpu_count() or 1
+    data = dict()
+    fingerprints = dict()
+    hashes = dict()
+    print("Parsing KEGG files")
+    with METRICS.stage("parse_files") as stage:
+        if cache_dir is not None:
+            for key, filename, _, description in sources:
+                fingerprints[key] = file_fingerprint([filename], hashes)
+                cached = read_cache(cache_dir, key, [filename], fingerprints[key])
+                if cached is not None:
+                    data[key] = cached
+                    print(len(data[key]), description, "records read from cache")
+            if kgml_folder is not None:
+                fingerprints['metabolic_reactions'] = file_fingerprint(xml_files, hashes)
+                cached = read_cache(cache_dir, 'metabolic_reactions', xml_files, fingerprints['metabolic_reactions'],
+                                    xml_args)
+                if cached is not None:
+                    data['metabolic_reactions'] = cached
+                    print(len(cached), "kgml reactions read from cache")
+        # inputs still to be parsed from archives, as {archive: {member: parse_record}}
+        archives = dict()
+        for key, filename, parse_record, _ in sources:
+            archive, member = split_archive_path(filename)
+            if key not in data and archive is not None:
+                archives.setdefault(archive, dict())[member] = parse_record
+        xml_source, xml_member = None, None
+        if kgml_folder is not None and 'metabolic_reactions' not in data and xml_archive:
+            xml_source, xml_member = split_archive_path(kgml_folder)
+            archives.setdefault(xml_source, dict())
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            archive_futures = dict()
+            for archive, parsers in archives.items():
+                archive_futures[archive] = executor.submit(read_kegg_archive, archive, parsers,
+                                                           xml_member if archive == xml_source else None,
+                                                           use_pathways, ignore_pathways)
+            futures = dict()
+            for key, filename, parse_record, _ in sources:
+                if key in data or split_archive_path(filename)[0] is not None:
+                    continue
+                if key in split and chunks > 1 and not compressed_input(filename):
+                    futures[key] = [executor.submit(parse_kegg_chunk, filename, parse_record, start, end)
+                                    for start, end in kegg_chunks(filename, chunks)]
+                else:
+                    futures[key] = [executor.submit(parse_kegg_file, filename, parse_record)]
+            if kgml_folder is not None and 'metabolic_reactions' not in data and not xml_archive:
+                xml_futures = [executor.submit(read_kgml_file, f) for f in xml_files]
+            for key, filename, _, description in sources:
+                if key in data:
+                    continue
+                archive, member = split_archive_path(filename)
+                if archive is not None:
+                    data[key] = archive_futures[archive].result()[0][member]
+                else:
+                    data[key] = dict()
+                    for future in futures[key]:
+                        data[key].update(future.result())
+                print(len(data[key]), description, "records created")
+                if cache_dir is not None:
+                    write_cache(cache_dir, key, [filename], fingerprints[key], data[key])
+            if kgml_folder is not None and 'metabolic_reactions' not in data:
+                if xml_archive:
+                    data['metabolic_reactions'] = archive_futures[xml_source].result()[1]
+                else:
+                    data['metabolic_reactions'] = list()
+                    for future in xml_futures:
+                        data['metabolic_reactions'].extend(future.result())
+                print(len(data['metabolic_reactions']), "kgml reactions created")
+                if cache_dir is not None:
+                    write_cache(cache_dir, 'metabolic_reactions', xml_files, fingerprints['metabolic_reactions'],
+                                data['metabolic_reactions'], xml_args)
+        # rclass triples depend only on the rclass file
+        triples = None
+        if cache_dir is not None:
+            triples = read_cache(cache_dir, 'triples', [rclass_file], fingerprints['rclass'])
+        if triples is None:
+            triples = find_triples(data['rclass'])
+            if cache_dir is not None:
+                write_cache(cache_dir, 'triples', [rclass_file], fingerprints['rclass'], triples)
+        data['triples'] = triples
+        if compact:
+            data = compact_kegg_data(data)
+        stage['records'] = sum(len(v) for v in data.values())
+    return data
+
+# Compact read-only records for parsed KEGG tables
+# Fields are held in __slots__ rather than a dictionary per record, KEGG ids are interned so that every reference to
+# a compound or pathway shares one string, and lists are stored as tuples with fixed width fields trimmed.  Records
+# behave as read-only dictionaries in which missing fields are absent, so the loaders and find_triples accept them
+class KeggRecord(Mapping):
+    __slots__ = ()
+
+    def __init__(self, record):
+        for field in self.__slots__:
+            value = record.get(field)
+            if field == "entry":
+                value = sys.intern(value)
+            elif isinstance(value, list):
+                value = compact_list(value)
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (field for field in self.__slots__ if getattr(self, field) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "{c}({d})".format(c=type(self).__name__, d=dict(self))
+
+
+class ReactionRecord(KeggRecord):
+    __slots__ = ("entry", "name", "definition", "equation", "rclass", "enzyme")
+
+
+class EnzymeRecord(KeggRecord):
+    __slots__ = ("entry", "name", "pathway")
+
+
+class RClassRecord(KeggRecord):
+    __slots__ = ("entry", "definition", "rpairs", "pathway")
+
+
+class CompoundRecord(KeggRecord):
+    __slots__ = ("entry", "name", "formula", "mass", "pathway")
+
+
+def compact_list(values):
+    # Tuple of trimmed, interned strings (or nested tuples for lists of lists)
+    return tuple(compact_list(v) if isinstance(v, list) else sys.intern(v.strip()) for v in values)
+
+
+# Convert the dictionaries returned by the readers into compact records
+def compact_kegg_data(data):
+    record_types = {"reactions": ReactionRecord, "enzymes": EnzymeRecord, "rclass": RClassRecord,
+                    "compounds": CompoundRecord}
+    compact = dict(data)
+    for key, record_type in record_types.items():
+        if key in data:
+            compact[key] = dict((sys.intern(entry), record_type(record)) for entry, record in data[key].items())
+    return compact
+
+
 def find_triples(rclass):
     triples = []
-    for r in rclass:
-        for p in rclass[r]['rpairs']:
-            rpair_triple = p.split("_")
-            rpair_triple.append(rclass[r]["entry"])
-            triples.append(rpair_triple)
+    with METRICS.stage("find_triples") as stage:
+        for r in rclass:
+            for p in rclass[r]['rpairs']:
+                rpair_triple = p.split("_")
+                rpair_triple.append(rclass[r]["entry"])
+                triples.append(rpair_triple)
+        stage['records'] = len(triples)
     return triples
 
 
-def flatten_dict(d):
-    out = list()
-    for k, v in d.items():
-        if type(v) is str:
-            out.append("{k}: \"{v}\"".format(k=k, v=v))
-        else:
-            out.append("{k}: {v}".format(k=k, v=v))
-    return ", ".join(out)
+# Restrict parsed KEGG data to the part reachable from a set of pathways, for partial builds
+# Enzymes, reaction classes and compounds are in scope when their pathway field names one of the pathways, and
+# reactions when one of their reaction classes or enzymes is in scope.  The reaction classes, enzymes and compounds
+# those reactions refer to are kept as well so that every relationship of the subgraph can be built.  Returns a new
+# dictionary with the keys of parse_kegg_files
+def pathway_scope(data, pathways):
+    with METRICS.stage("pathway_scope") as stage:
+        pathways = set(pathways)
+
+        def in_scope(record):
+            return any(pathway_number(p) in pathways for p in record.get('pathway', []))
+
+        enzymes = dict((k, v) for k, v in data['enzymes'].items() if in_scope(v))
+        rclass = dict((k, v) for k, v in data['rclass'].items() if in_scope(v))
+        compounds = set(k for k, v in data['compounds'].items() if in_scope(v))
+        reactions = dict()
+        for k, r in data['reactions'].items():
+            reaction_enzymes = ["EC " + e for e in r['enzyme'].split()] if 'enzyme' in r else []
+            if any(rc[0] in rclass for rc in r.get('rclass', [])) or any(e in enzymes for e in reaction_enzymes):
+                reactions[k] = r
+        for r in reactions.values():
+            for rc in r.get('rclass', []):
+                if rc[0] in data['rclass']:
+                    rclass[rc[0]] = data['rclass'][rc[0]]
+            if 'enzyme' in r:
+                for e in ["EC " + r['enzyme']] + ["EC " + e for e in r['enzyme'].split()]:
+                    if e in data['enzymes']:
+                        enzymes[e] = data['enzymes'][e]
+        compounds.update(reaction_compounds(reactions, rclass))
+        for rc in rclass.values():
+            for p in rc.get('rpairs', []):
+                compounds.update(p.split("_"))
+        scoped = {"reactions": reactions,
+                  "enzymes": enzymes,
+                  "rclass": rclass,
+                  "compounds": dict((k, data['compounds'][k]) for k in compounds if k in data['compounds']),
+                  "triples": [t for t in data['triples'] if t[2] in rclass]}
+        if 'metabolic_reactions' in data:
+            scoped['metabolic_reactions'] = [r for r in data['metabolic_reactions']
+                                             if pathway_number(r['pathway_id']) in pathways]
+        print("{p} pathways in scope: {r} reactions, {rc} reaction classes, {e} enzymes, {c} compounds".format(
+            p=len(pathways), r=len(reactions), rc=len(rclass), e=len(enzymes), c=len(scoped['compounds'])))
+        stage['records'] = sum(len(v) for v in scoped.values())
+    return scoped
+
+
+# Constraints and indexes used by the loaders and queries
+# Each entry is (name, label or relationship type, property).  Constraints are uniqueness constraints on nodes
+SCHEMA = {
+    "constraints": [("compound_entry", "Compound", "entry"),
+                    ("transformation_name", "Transformation", "name")],
+    "node_indexes": [("compound_mass", "Compound", "mass"),
+                     ("compound_hub", "Compound", "hub"),
+                     ("compound_component", "Compound", "component")],
+    "relationship_indexes": [("reaction_entry", "REACTION", "entry"),
+                             ("reaction_rclass_entry", "REACTION", "rclass_entry"),
+                             ("reaction_abs_delta_mass", "REACTION", "abs_delta_mass"),
+                             ("connection_abs_delta_mass", "CONNECTION", "abs_delta_mass"),
+                             ("reaction_transformation", "REACTION", "transformation"),
+                             ("connection_transformation", "CONNECTION", "transformation"),
+                             ("reaction_model", "REACTION", "model"),
+                             ("connection_model", "CONNECTION", "model")]
+}
+
+
+def server_version(graph):
+    # Version of the neo4j server as a tuple of integers, e.g. (3, 5, 35), or (0,) if it cannot be read
+    for component in graph.data("CALL dbms.components() YIELD name, versions"):
+        if component["name"] == "Neo4j Kernel":
+            return tuple(int(v) for v in re.findall(r"\d+", component["versions"][0])[0:3])
+    return (0,)
+
+
+def named_schema(version):
+    # Named indexes, IF NOT EXISTS, relationship property indexes and SHOW INDEXES all need neo4j 4.4 or later
+    return version >= (4, 4)
+
+
+def schema_statements(schema=SCHEMA, version=(4, 4)):
+    # Cypher statements creating the constraints and indexes of a schema definition on a given server version
+    # Servers before 4.4 (including the 3.x servers py2neo v3 connects to) are given the unnamed 3.x syntax, which
+    # is idempotent, and have no relationship property indexes - relationship lookups on them are scans
+    statements = list()
+    if named_schema(version):
+        for name, label, prop in schema.get("constraints", []):
+            statements.append("CREATE CONSTRAINT {n} IF NOT EXISTS FOR (n:{l}) REQUIRE n.{p} IS UNIQUE"
+                              .format(n=name, l=label, p=prop))
+        for name, label, prop in schema.get("node_indexes", []):
+            statements.append("CREATE INDEX {n} IF NOT EXISTS FOR (n:{l}) ON (n.{p})"
+                              .format(n=name, l=label, p=prop))
+        for name, rel_type, prop in schema.get("relationship_indexes", []):
+            statements.append("CREATE INDEX {n} IF NOT EXISTS FOR ()-[r:{t}]-() ON (r.{p})"
+                              .format(n=name, t=rel_type, p=prop))
+    else:
+        for name, label, prop in schema.get("constraints", []):
+            statements.append("CREATE CONSTRAINT ON (n:{l}) ASSERT n.{p} IS UNIQUE".format(l=label, p=prop))
+        for name, label, prop in schema.get("node_indexes", []):
+            statements.append("CREATE INDEX ON :{l}({p})".format(l=label, p=prop))
+    return statements
+
+
+# Create constraints and indexes and wait until they are online.  Run before loading so that every MERGE on
+# Compound.entry is an index lookup rather than a label scan
+def create_schema(graph, schema=SCHEMA, timeout=300):
+    with METRICS.stage("create_schema") as stage:
+        version = server_version(graph)
+        statements = schema_statements(schema, version)
+        if not named_schema(version) and schema.get("relationship_indexes"):
+            print("Relationship indexes need neo4j 4.4 or later, skipped on", ".".join(str(v) for v in version))
+        for statement in statements:
+            graph.run(statement)
+        graph.run("CALL db.awaitIndexes($timeout)", {"timeout": timeout})
+        stage['statements'] = len(statements) + 2
+    return
+
+
+def index_key(index):
+    # (label or relationship type, property) of a row of CALL db.indexes(), whose columns differ between versions
+    if index.get("labelsOrTypes"):
+        return index["labelsOrTypes"][0], index["properties"][0]
+    if index.get("tokenNames"):
+        return index["tokenNames"][0], index["properties"][0]
+    match = re.search(r":(\w+)\((\w+)\)", index.get("description", ""))
+    return (match.group(1), match.group(2)) if match else None
+
+
+# Check that every constraint and index of a schema definition exists and is online
+# Returns a list of the names of missing or failed indexes.  Relationship indexes are not checked on servers
+# without them
+def verify_schema(graph, schema=SCHEMA):
+    version = server_version(graph)
+    if named_schema(version):
+        indexes = dict((i["name"], i["state"]) for i in graph.data("SHOW INDEXES YIELD name, state"))
+        kinds = ["constraints", "node_indexes", "relationship_indexes"]
+    else:
+        # unnamed indexes are matched on label and property; each uniqueness constraint has a backing index
+        states = dict((index_key(i), i["state"]) for i in graph.data("CALL db.indexes()"))
+        indexes = dict((name, states.get((label, prop))) for kind in ["constraints", "node_indexes"]
+                       for name, label, prop in schema.get(kind, []) if (label, prop) in states)
+        kinds = ["constraints", "node_indexes"]
+    problems = list()
+    for kind in kinds:
+        for name, _, _ in schema.get(kind, []):
+            if indexes.get(name) != "ONLINE":
+                problems.append(name)
+                print("Schema check failed for", name, "-", indexes.get(name, "missing"))
+    if not problems:
+        print("Schema verified")
+    return problems
+
+
+def mark_load(graph):
+    # Record the time of the latest load so that query services (see queryKEGG) can clear their caches
+    graph.run("MERGE (b:Build {name: 'kegg'}) SET b.loaded = timestamp()")
+    return
+
+
+# Collect node and relationship rows and write them to neo4j as parameterised UNWIND ... MERGE batches
+# Every batch of a given shape uses the same query text so the server can reuse its query plan
+# Nodes are merged on a key property and relationships on their end nodes plus a tuple of key properties, with
+# any remaining properties applied with SET.  End nodes are matched by key, so they must be merged first
+class BatchWriter:
+    def __init__(self, graph, batch_size=5000):
+        self.graph = graph
+        self.batch_size = batch_size
+        self.pending = dict()
+        self.phase = dict()
+        self.rows = 0
+        self.batches = 0
+        self.elapsed = 0.0
+
+    def merge_node(self, label, properties, key="entry", replace=False):
+        query = "UNWIND $rows AS row MERGE (n:{label} {{{key}: row.{key}}}) SET n {op} row"\
+            .format(label=label, key=key, op="=" if replace else "+=")
+        self.add(query, properties, 2)
+
+    def merge_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                           label="Compound", node_key="entry", replace=False):
+        query = "UNWIND $rows AS row " \
+                "MATCH (a:{label} {{{node_key}: row.start}}) " \
+                "MATCH (b:{label} {{{node_key}: row.end}}) " \
+                "MERGE (a)-[r:{rel_type}{merge_keys}]-{arrow}(b) " \
+                "SET r {op} row.properties"\
+            .format(label=label, node_key=node_key, rel_type=rel_type, arrow=">" if directed else "",
+                    merge_keys=relationship_key_map(keys), op="=" if replace else "+=")
+        self.add(query, {"start": start, "end": end, "properties": properties or dict()}, 3)
+
+    def delete_node(self, label, value, key="entry"):
+        query = "UNWIND $rows AS row MATCH (n:{label} {{{key}: row.value}}) DETACH DELETE n"\
+            .format(label=label, key=key)
+        self.add(query, {"value": value}, 1)
+
+    def delete_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                            label="Compound", node_key="entry"):
+        query = "UNWIND $rows AS row " \
+                "MATCH (a:{label} {{{node_key}: row.start}})-[r:{rel_type}{merge_keys}]-{arrow}" \
+                "(b:{label} {{{node_key}: row.end}}) DELETE r"\
+            .format(label=label, node_key=node_key, rel_type=rel_type, arrow=">" if directed else "",
+                    merge_keys=relationship_key_map(keys))
+        self.add(query, {"start": start, "end": end, "properties": properties or dict()}, 0)
+
+    def add(self, query, row, phase):
+        rows = self.pending.setdefault(query, [])
+        rows.append(row)
+        self.phase[query] = phase
+        if len(rows) >= self.batch_size:
+            # Rows from earlier phases are always sent first, so relationship batches can MATCH their end nodes
+            for earlier in sorted([q for q in self.pending if self.phase[q] < phase], key=lambda q: self.phase[q]):
+                self.send(earlier)
+            self.send(query)
+
+    def send(self, query):
+        rows = self.pending.pop(query, [])
+        if not rows:
+            return
+        start_time = time.time()
+        self.graph.run(query, {"rows": rows})
+        self.elapsed += time.time() - start_time
+        self.rows += len(rows)
+        self.batches += 1
+
+    def flush(self):
+        # Relationship deletes, node deletes, node merges then relationship merges
+        for query in sorted(self.pending, key=lambda q: self.phase[q]):
+            self.send(query)
+
+    def close(self):
+        self.flush()
+        rate = self.rows / self.elapsed if self.elapsed > 0 else 0
+        print("Wrote", self.rows, "rows in", self.batches, "batches,", round(self.elapsed, 1), "seconds,",
+              int(rate), "rows/sec")
+
+
+# Write UNWIND batches concurrently over several sessions
+# Rows are split into partitions by compound pair (or node key), so the same pair is always written by the same
+# partition.  Each partition has its own session and sends its batches in order, while partitions run in parallel.
+# Phases are separated by a barrier, so every node is written before any relationship which matches it.  Batches
+# failing with a transient error such as a deadlock are retried with exponential backoff
+# connect() opens the session of each partition.  It is required, as a single py2neo Graph is not safe to share
+# between threads
+class ParallelBatchWriter(BatchWriter):
+    def __init__(self, graph, batch_size=5000, workers=4, connect=None, retries=5, backoff=0.5):
+        if connect is None:
+            raise ValueError("Writing with {w} workers needs connect, a function opening one session per worker"
+                             .format(w=workers))
+        BatchWriter.__init__(self, graph, batch_size)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        # one session per partition
+        self.graphs = [connect() for _ in range(workers)]
+        self.executors = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+        self.futures = [list() for _ in range(workers)]
+        self.current_phase = 0
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.retried = 0
+
+    def add(self, query, row, phase):
+        if phase > self.current_phase:
+            self.barrier(phase)
+        self.current_phase = max(self.current_phase, phase)
+        partition = self.partition(row)
+        key = (query, partition)
+        rows = self.pending.setdefault(key, [])
+        rows.append(row)
+        self.phase[key] = phase
+        if len(rows) >= self.batch_size:
+            self.send(key)
+
+    def partition(self, row):
+        if "start" in row:
+            return hash(tuple(sorted((row["start"], row["end"])))) % self.workers
+        return hash(row.get("entry", row.get("value"))) % self.workers
+
+    def send(self, key):
+        rows = self.pending.pop(key, [])
+        if not rows:
+            return
+        query, partition = key
+        if self.start_time is None:
+            self.start_time = time.time()
+        futures = self.futures[partition]
+        # bound the number of batches held in memory for each partition
+        while len(futures) > 2:
+            futures.pop(0).result()
+        futures.append(self.executors[partition].submit(self.run_batch, self.graphs[partition], query, rows))
+
+    def run_batch(self, graph, query, rows):
+        attempt = 0
+        while True:
+            try:
+                graph.run(query, {"rows": rows})
+                break
+            except Exception as error:
+                if attempt >= self.retries or not transient_error(error):
+                    raise
+                with self.lock:
+                    self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+        with self.lock:
+            self.rows += len(rows)
+            self.batches += 1
+
+    def wait(self):
+        for futures in self.futures:
+            while futures:
+                futures.pop(0).result()
+
+    def barrier(self, phase):
+        # Send and wait for every batch from phases before this one
+        for key in sorted([k for k in self.pending if self.phase[k] < phase], key=lambda k: self.phase[k]):
+            self.send(key)
+        self.wait()
+
+    def flush(self):
+        for phase in sorted(set(self.phase[k] for k in self.pending)):
+            for key in [k for k in self.pending if self.phase[k] == phase]:
+                self.send(key)
+            self.wait()
+        self.wait()
+
+    def close(self):
+        self.flush()
+        for executor in self.executors:
+            executor.shutdown()
+        if self.start_time is not None:
+            self.elapsed = time.time() - self.start_time
+        if self.retried:
+            print(self.retried, "batches retried after transient errors")
+        BatchWriter.close(self)
+
+
+def transient_error(error):
+    # Neo4j transient errors, such as deadlocks and lock timeouts, succeed when retried
+    code = str(getattr(error, "code", "") or "")
+    return "TransientError" in code or "TransientError" in type(error).__name__ or \
+        "Deadlock" in type(error).__name__
+
+
+def batch_writer(graph, batch_size=5000, workers=None, connect=None):
+    # BatchWriter, or ParallelBatchWriter if more than one worker is requested
+    if workers is not None and workers > 1:
+        return ParallelBatchWriter(graph, batch_size, workers, connect)
+    return BatchWriter(graph, batch_size)
+
+
+# Storage backend behind the create_db_* loaders
+# A backend clears the store, creates its schema, returns a writer accepting the rows of the write_* functions,
+# records each load and verifies its schema.  Neo4jBackend wraps a py2neo Graph; sqliteGraph.SqliteBackend keeps
+# the graph in an embedded SQLite file for builds, tests and benchmarks without a server
+class Neo4jBackend:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def clear(self):
+        self.graph.delete_all()
+
+    def create_schema(self):
+        create_schema(self.graph)
+
+    def writer(self, batch_size=5000, workers=None, connect=None):
+        return batch_writer(self.graph, batch_size, workers, connect)
+
+    def mark_load(self):
+        mark_load(self.graph)
+
+    def verify_schema(self):
+        return verify_schema(self.graph)
+
+
+def graph_backend(graph):
+    # The loaders accept either a py2neo Graph or a backend
+    return graph if hasattr(graph, "writer") else Neo4jBackend(graph)
+
+
+def relationship_key_map(keys):
+    # Cypher property map matching a relationship on its key properties
+    if not keys:
+        return ""
+    return " {" + ", ".join("{k}: row.properties.{k}".format(k=k) for k in keys) + "}"
+
+
+def relationship_key(rel_type, start, end, properties, keys=(), directed=False):
+    # Identity of a merged relationship - undirected relationships match in either direction, as MERGE does
+    ends = (start, end) if directed else tuple(sorted((start, end)))
+    return rel_type, ends, directed, tuple(properties.get(k) for k in keys)
+
+
+# Write deduplicated node and relationship files for neo4j-admin import in place of transactions
+# Accepts the same rows as BatchWriter.  Rows are streamed to a temporary file per label or relationship type while
+# column types are discovered, then converted to a typed header file and a body file when the writer is closed
+# Only the keys of rows already written are held in memory, for deduplication
+class CsvWriter:
+    array_delimiter = "|"
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.files = dict()
+        self.columns = dict()
+        self.seen = dict()
+        self.rows = 0
+
+    def merge_node(self, label, properties, key="entry"):
+        self.write(label, properties[key], properties, {key: "{k}:ID({l})".format(k=key, l=label)})
+
+    def merge_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                           label="Compound", node_key="entry"):
+        properties = properties or dict()
+        row_key = relationship_key(rel_type, start, end, properties, keys, directed)
+        row = dict(properties)
+        row[":START_ID"] = start
+        row[":END_ID"] = end
+        self.write(rel_type, row_key, row, {":START_ID": ":START_ID({l})".format(l=label),
+                                            ":END_ID": ":END_ID({l})".format(l=label)})
+
+    def write(self, name, row_key, row, id_columns):
+        if name not in self.files:
+            self.files[name] = open(os.path.join(self.folder, name + ".jsonl.tmp"), "w")
+            self.columns[name] = dict(id_columns)
+            self.seen[name] = set()
+        if row_key in self.seen[name]:
+            return
+        self.seen[name].add(row_key)
+        columns = self.columns[name]
+        for k, v in row.items():
+            if k not in id_columns:
+                columns[k] = csv_type(columns.get(k), v)
+        self.files[name].write(json.dumps(row) + "\n")
+        self.rows += 1
+
+    def header(self, name):
+        header = list()
+        for column, column_type in self.columns[name].items():
+            if column_type is None or column_type == "string":
+                header.append(column)
+            elif ":" in column_type:
+                header.append(column_type)
+            else:
+                header.append("{c}:{t}".format(c=column, t=column_type))
+        return header
+
+    def close(self):
+        for name, f in self.files.items():
+            f.close()
+            columns = self.columns[name]
+            with open(os.path.join(self.folder, name + "_header.csv"), "w", newline="") as out:
+                csv.writer(out).writerow(self.header(name))
+            with open(os.path.join(self.folder, name + ".jsonl.tmp")) as rows, \
+                    open(os.path.join(self.folder, name + ".csv"), "w", newline="") as out:
+                body = csv.writer(out)
+                for line in rows:
+                    row = json.loads(line)
+                    body.writerow([csv_value(row.get(c), t) for c, t in columns.items()])
+            os.remove(os.path.join(self.folder, name + ".jsonl.tmp"))
+        self.files = dict()
+        print("Wrote", self.rows, "rows to", self.folder)
+        print(self.import_command())
+
+    def import_command(self):
+        # neo4j-admin command to load the files written by this writer
+        args = ["neo4j-admin import", "--array-delimiter=\"{d}\"".format(d=self.array_delimiter)]
+        for name, columns in self.columns.items():
+            kind = "relationships" if ":START_ID" in columns else "nodes"
+            args.append("--{kind}={name}={h},{b}".format(kind=kind, name=name,
+                                                         h=os.path.join(self.folder, name + "_header.csv"),
+                                                         b=os.path.join(self.folder, name + ".csv")))
+        return " ".join(args)
+
+
+# Write node and edge tables as Parquet or Arrow IPC datasets for analytics, in place of a database
+# Accepts the same rows as BatchWriter, one table per label or relationship type, deduplicated as by CsvWriter
+# Each row is written once.  Tables whose rows carry pathways (pathway, rclass_pathway or enzyme_pathway) are
+# partitioned as pathway_partition=00010 folders on the first pathway of each row (pathway_partition=none for rows
+# without pathways), and every pathway of a row is listed in a separate {name}_pathway membership table of its key
+# columns and pathway number, e.g. Compound_pathway (entry, pathway), so selecting a pathway is a join on the keys.
+# Parquet files are zstd compressed; Arrow files are uncompressed by default so they can be memory mapped and read
+# without copying
+class ColumnarWriter:
+    def __init__(self, folder, format="parquet", compression=None):
+        if pyarrow is None:
+            raise ImportError("pyarrow is required for columnar export")
+        self.folder = folder
+        self.format = {"parquet": "parquet", "arrow": "ipc"}[format]
+        self.compression = compression if compression is not None or format != "parquet" else "zstd"
+        self.tables = dict()
+        self.keys = dict()
+        self.rows = 0
+
+    def merge_node(self, label, properties, key="entry"):
+        self.keys.setdefault(label, [key])
+        self.write(label, properties[key], properties)
+
+    def merge_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                           label="Compound", node_key="entry"):
+        properties = properties or dict()
+        row = {"start": start, "end": end}
+        row.update(properties)
+        self.keys.setdefault(rel_type, ["start", "end"] + [k for k in keys if k not in ("start", "end")])
+        self.write(rel_type, relationship_key(rel_type, start, end, properties, keys, directed), row)
+
+    def write(self, name, row_key, row):
+        rows = self.tables.setdefault(name, dict())
+        if row_key not in rows:
+            rows[row_key] = row
+            self.rows += 1
+
+    def close(self):
+        written = dict()
+        for name, rows in self.tables.items():
+            rows = list(rows.values())
+            pathways = [row_pathways(row) for row in rows]
+            columns = dict()
+            for row in rows:
+                for column in row:
+                    columns.setdefault(column, None)
+            data = dict((c, [columnar_value(row.get(c)) for row in rows]) for c in columns)
+            partitioning = None
+            if any(pathways):
+                data["pathway_partition"] = [p[0] if p else "none" for p in pathways]
+                partitioning = pyarrow.dataset.partitioning(
+                    pyarrow.schema([("pathway_partition", pyarrow.string())]), flavor="hive")
+                # one membership row per pathway of each row
+                keys = self.keys[name]
+                membership = dict((k, [data[k][i] for i, p in enumerate(pathways) for _ in p]) for k in keys)
+                membership["pathway"] = [n for p in pathways for n in p]
+                written[name + "_pathway"] = self.write_table(name + "_pathway", pyarrow.table(membership))
+            written[name] = self.write_table(name, pyarrow.table(data), partitioning)
+        self.tables = dict()
+        print("Wrote", self.rows, "rows to", self.folder)
+        return written
+
+    def write_table(self, name, table, partitioning=None):
+        path = os.path.join(self.folder, name)
+        file_format = pyarrow.dataset.ParquetFileFormat() if self.format == "parquet" \
+            else pyarrow.dataset.IpcFileFormat()
+        pyarrow.dataset.write_dataset(table, path, format=self.format, partitioning=partitioning,
+                                      file_options=file_format.make_write_options(compression=self.compression),
+                                      existing_data_behavior="delete_matching")
+        return path
+
+
+def row_pathways(row):
+    # Distinct pathway numbers of a node or edge row, in order
+    for field in ["pathway", "rclass_pathway", "enzyme_pathway"]:
+        if row.get(field):
+            values = [row[field]] if isinstance(row[field], str) else row[field]
+            numbers = [pathway_number(p) for p in values]
+            return list(dict.fromkeys(n for n in numbers if n is not None))
+    return []
+
+
+def columnar_value(value):
+    # Tuples from compact records are written as lists
+    if isinstance(value, tuple):
+        return [columnar_value(v) for v in value]
+    if isinstance(value, list):
+        return [columnar_value(v) for v in value]
+    return value
+
+
+def csv_type(current, value):
+    # Widen the neo4j-admin type of a column to accommodate value
+    if value is None:
+        return current
+    if isinstance(value, (list, tuple)):
+        value_type = "string[]"
+    elif isinstance(value, bool):
+        value_type = "boolean"
+    elif isinstance(value, int):
+        value_type = "long"
+    elif isinstance(value, float):
+        value_type = "double"
+    else:
+        value_type = "string"
+    if current is None or current == value_type:
+        return value_type
+    if {current, value_type} == {"long", "double"}:
+        return "double"
+    if "string[]" in (current, value_type):
+        return "string[]"
+    return "string"
+
+
+def csv_value(value, column_type):
+    # Format a value for a column of the given neo4j-admin type
+    if value is None:
+        return ""
+    if column_type == "string[]":
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return CsvWriter.array_delimiter.join(str(v) for v in value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, tuple)):
+        return " ".join(str(v) for v in value)
+    return value
+
+
+def compound_properties(compounds, entry):
+    # Compound properties, or a record with just the entry id if the compound is unknown
+    if entry in compounds.keys():
+        return dict(compounds[entry])
+    return {"entry": entry}
+
+
+def write_compounds(writer, compounds, entries, analytics=None):
+    # Node phase - write each distinct compound once.  Relationships refer to compounds by entry only
+    # analytics adds the properties computed by graph_analytics to each compound
+    for entry in sorted(entries):
+        properties = compound_properties(compounds, entry)
+        if analytics is not None and entry in analytics:
+            properties.update(analytics[entry])
+        writer.merge_node("Compound", properties)
+
+
+# Compounds with at least this many CONNECTION neighbours are flagged as hubs, i.e. currency metabolites such as
+# water, ATP and NAD+ which join otherwise unrelated parts of the network
+HUB_DEGREE = 50
+
+
+def connection_pairs(reactions, rclass):
+    # Distinct compound pairs joined by a CONNECTION relationship, as enumerated by write_reactions
+    pairs = set()
+    for r in reactions.values():
+        for rc in r.get('rclass', []):
+            if rc[0] in rclass.keys():
+                pairs.add(tuple(sorted(rc[1:3])))
+    return pairs
+
+
+# Precompute per-compound properties of the CONNECTION graph for pathfinding queries
+# Returns a dictionary of compound entry to its degree, hub flag (degree >= hub_degree), connected component and
+# component size.  Components are named by their smallest compound entry, so ids are stable between releases
+# unless components merge or split.  Two compounds can only be joined by a path if their components match
+def graph_analytics(reactions, rclass, hub_degree=HUB_DEGREE):
+    with METRICS.stage("graph_analytics") as stage:
+        adjacency = dict()
+        for c1, c2 in connection_pairs(reactions, rclass):
+            adjacency.setdefault(c1, set())
+            adjacency.setdefault(c2, set())
+            if c1 != c2:
+                adjacency[c1].add(c2)
+                adjacency[c2].add(c1)
+        component = dict()
+        sizes = dict()
+        for entry in sorted(adjacency):
+            if entry in component:
+                continue
+            # iterative depth first search from the smallest unvisited entry
+            component[entry] = entry
+            stack = [entry]
+            size = 0
+            while stack:
+                node = stack.pop()
+                size += 1
+                for neighbour in adjacency[node]:
+                    if neighbour not in component:
+                        component[neighbour] = entry
+                        stack.append(neighbour)
+            sizes[entry] = size
+        analytics = dict((entry, {"degree": len(neighbours), "hub": len(neighbours) >= hub_degree,
+                                  "component": component[entry], "component_size": sizes[component[entry]]})
+                         for entry, neighbours in adjacency.items())
+        print(len(analytics), "compounds,", sum(a["hub"] for a in analytics.values()), "hubs,", len(sizes),
+              "components, largest", max(sizes.values()) if sizes else 0)
+        stage['records'] = len(analytics)
+    return analytics
+
+
+def delta_masses(pairs, compounds):
+    # Mass of the first compound less the second for a list of compound pairs, rounded to 4 decimal places
+    # Computed in one vectorized pass.  Returns an array aligned with pairs, NaN where either mass is unknown
+    entries = sorted(set(c for pair in pairs for c in pair))
+    position = dict((entry, i) for i, entry in enumerate(entries))
+    mass = np.array([compounds[e].get('mass', np.nan) if e in compounds.keys() else np.nan for e in entries],
+                    dtype=float)
+    index = np.array([(position[a], position[b]) for a, b in pairs], dtype=int).reshape(-1, 2)
+    return np.round(mass[index[:, 0]] - mass[index[:, 1]], 4)
+
+
+def delta_mass_lookup(pairs, compounds):
+    # Dictionary of compound pair to delta mass, for pairs where both masses are known
+    deltas = delta_masses(pairs, compounds)
+    return dict((pair, float(d)) for pair, d in zip(pairs, deltas) if not np.isnan(d))
+
+
+def reaction_pairs(reactions, rclass):
+    # Compound pairs of the REACTION relationships of write_reactions, one per relationship
+    return [(rc[1], rc[2]) for r in reactions.values() for rc in r.get('rclass', []) if rc[0] in rclass.keys()]
+
+
+def xml_pairs(metabolic_reactions):
+    # (product, substrate) pairs of the REACTION relationships of write_xml, giving product less substrate masses
+    return [(product, substrate) for m in metabolic_reactions for react_name in m["name"]
+            for _, substrate in m["substrates"] for _, product in m["products"]]
+
+
+def triple_pairs(triples):
+    return [(t[0], t[1]) for t in triples]
+
+
+def xml_compounds(metabolic_reactions):
+    # Entries of every substrate and product of the kgml reactions
+    entries = set()
+    for m in metabolic_reactions:
+        entries.update(c[1] for c in m["substrates"] + m["products"])
+    return entries
+
+
+def triple_compounds(triples):
+    return set(t[0] for t in triples) | set(t[1] for t in triples)
+
+
+# Exact masses of common transformations, used to name clusters of the transformation catalog
+TRANSFORMATIONS = {"H2": 2.015650,
+                   "CH2": 14.015650,
+                   "NH": 15.010899,
+                   "O": 15.994915,
+                   "NH3": 17.026549,
+                   "H2O": 18.010565,
+                   "CO": 27.994915,
+                   "CH2O": 30.010565,
+                   "C2H2O": 42.010565,
+                   "CO2": 43.989829,
+                   "SO3": 79.956815,
+                   "HPO3": 79.966331,
+                   "C6H10O5": 162.052824}
+
+
+# Catalog of the mass transformations of the compound pairs of a set of relationships, from their delta masses
+# Distinct absolute delta masses are clustered, a cluster being a run of sorted values with gaps of at most
+# tolerance Da and spanning at most twice the tolerance.  Clusters are counted in distinct compound pairs, so a pair
+# shared by several reactions counts once.  Clusters matching TRANSFORMATIONS within the tolerance become
+# transformations named by formula; other clusters only become transformations, named by mass, when they cover at
+# least min_pairs distinct pairs.  Gains and losses share a transformation; the sign is kept in the delta_mass of
+# each relationship
+# Returns a dictionary of absolute delta mass to its transformation {name, mass, count}, count being distinct pairs
+def transformation_catalog(pairs, compounds, tolerance=0.002, min_pairs=10):
+    with METRICS.stage("transformation_catalog") as stage:
+        pairs = list(set(tuple(sorted(pair)) for pair in pairs))
+        deltas = np.abs(delta_masses(pairs, compounds))
+        values, counts = np.unique(deltas[~np.isnan(deltas)], return_counts=True)
+        clusters = list()
+        for value, count in zip(values.tolist(), counts.tolist()):
+            if clusters and value - clusters[-1][-1][0] <= tolerance and value - clusters[-1][0][0] <= 2 * tolerance:
+                clusters[-1].append((value, count))
+            else:
+                clusters.append([(value, count)])
+        catalog = dict()
+        for cluster in clusters:
+            count = sum(c for _, c in cluster)
+            mass = round(sum(v * c for v, c in cluster) / count, 4)
+            names = [name for name, m in TRANSFORMATIONS.items() if abs(m - mass) <= tolerance]
+            if not names and count < min_pairs:
+                continue
+            transformation = {"name": names[0] if names else "{m:.4f}".format(m=mass), "mass": mass, "count": count}
+            for value, _ in cluster:
+                catalog[value] = transformation
+        stage['records'] = len(set(t["name"] for t in catalog.values()))
+        print(stage['records'], "transformations from", len(values), "distinct delta masses")
+    return catalog
+
+
+def write_transformations(writer, catalog):
+    # Node phase - one Transformation node per transformation, with the number of compound pairs it describes
+    written = set()
+    for transformation in sorted(catalog.values(), key=lambda t: t["mass"]):
+        if transformation["name"] not in written:
+            written.add(transformation["name"])
+            writer.merge_node("Transformation", dict(transformation), key="name")
+
+
+def transformation_name(catalog, delta_mass):
+    # Transformation of a delta mass, or None
+    if catalog is None or delta_mass is None:
+        return None
+    transformation = catalog.get(abs(delta_mass))
+    return transformation["name"] if transformation else None
 
 
 # Create and populate a neo4j database using data from reactions
 # Reaction data are cross-referenced with compounds, rclass and enzyme
 # Two sets of relationships are generated - connections which specify a non-directional edge between two compound
 # nodes and reactions which are directional and contain additional data
-def create_db_from_reactions(reactions, graph, enzymes=None, compounds=None, rclass=None):
-    # clear old data
-    graph.delete_all()
-    # begin Cypher transaction
-    tx = graph.begin()
-    cursors = []
+# With workers > 1 batches are written concurrently, one session per worker, using connect() to open each session
+# With a checkpoint_file, reactions are written in sorted order and committed every chunk_size reactions, recording
+# the last committed reaction.  A restarted load with the same inputs resumes from the checkpoint without clearing
+# the database
+# Compounds are given the degree, hub flag and component properties of graph_analytics, unless hub_degree is None
+# With transformations, Transformation nodes from transformation_catalog are written and each relationship is given
+# the name of its transformation, so that e.g. every dehydration is found by transformation (an index lookup on
+# neo4j 4.4 or later, see schema_statements)
+# graph is a py2neo Graph or another backend (see Neo4jBackend), as for the other loaders
+def create_db_from_reactions(reactions, graph, enzymes=None, compounds=None, rclass=None, batch_size=5000,
+                             workers=None, connect=None, checkpoint_file=None, chunk_size=1000,
+                             hub_degree=HUB_DEGREE, transformations=True):
+    with METRICS.stage("load_reactions") as stage:
+        backend = graph_backend(graph)
+        checkpoint = None
+        if checkpoint_file is not None:
+            inputs = data_hash(reactions, enzymes, compounds, rclass)
+            checkpoint = read_checkpoint(checkpoint_file, inputs)
+        if checkpoint is None:
+            # clear old data
+            backend.clear()
+        else:
+            print("Resuming load after reaction", checkpoint['last_reaction'])
+        backend.create_schema()
+        analytics = graph_analytics(reactions, rclass, hub_degree) if hub_degree is not None else None
+        catalog = transformation_catalog(reaction_pairs(reactions, rclass), compounds) \
+            if transformations else None
+        writer = backend.writer(batch_size, workers, connect)
+        with METRICS.stage("create_rows"):
+            if checkpoint_file is None:
+                write_reactions(writer, reactions, enzymes, compounds, rclass, analytics=analytics, catalog=catalog)
+            else:
+                if checkpoint is None:
+                    write_compounds(writer, compounds, reaction_compounds(reactions, rclass), analytics)
+                    if catalog is not None:
+                        write_transformations(writer, catalog)
+                    writer.flush()
+                    checkpoint = {"inputs": inputs, "last_reaction": None}
+                    write_checkpoint(checkpoint_file, checkpoint)
+                keys = sorted(reactions)
+                if checkpoint['last_reaction'] is not None:
+                    keys = [k for k in keys if k > checkpoint['last_reaction']]
+                for i in range(0, len(keys), chunk_size):
+                    chunk = dict((k, reactions[k]) for k in keys[i:i + chunk_size])
+                    write_reactions(writer, chunk, enzymes, compounds, rclass, nodes=False, catalog=catalog)
+                    writer.flush()
+                    checkpoint['last_reaction'] = keys[min(i + chunk_size, len(keys)) - 1]
+                    write_checkpoint(checkpoint_file, checkpoint)
+        writer.close()
+        backend.mark_load()
+        backend.verify_schema()
+        if checkpoint_file is not None:
+            os.remove(checkpoint_file)
+        stage['records'] = writer.rows
+        stage['statements'] = writer.batches
+    return
+
+
+def data_hash(*datasets):
+    # Content hash of a set of parsed dictionaries, used to check that a checkpoint belongs to the same inputs
+    sha = hashlib.sha1()
+    for data in datasets:
+        for key in sorted(data):
+            sha.update(json.dumps([key, data[key]], sort_keys=True, default=dict).encode())
+        sha.update(b"///")
+    return sha.hexdigest()
+
+
+def read_checkpoint(checkpoint_file, inputs):
+    # Checkpoint of an interrupted load, or None if there is none for these inputs
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("inputs") != inputs:
+        print("Checkpoint is for different inputs and is ignored")
+        return None
+    return checkpoint
+
+
+def write_checkpoint(checkpoint_file, checkpoint):
+    with open(checkpoint_file + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+
+def reaction_compounds(reactions, rclass):
+    # Entries of the compounds joined by a reaction class pair of any reaction
+    entries = set()
+    for r in reactions.values():
+        for rc in r.get('rclass', []):
+            if rc[0] in rclass.keys():
+                entries.update(rc[1:3])
+    return entries
+
+
+# Generate compound nodes and REACTION and CONNECTION relationships from reactions through a writer
+# With nodes=False only relationships are written, the compounds having been written already
+# catalog is a transformation catalog (see transformation_catalog) naming the transformation of each relationship
+def write_reactions(writer, reactions, enzymes=None, compounds=None, rclass=None, nodes=True, analytics=None,
+                    catalog=None):
     # iterate over each reaction and add to database
     # include optional data as properties if available
     print("Processing", len(reactions), "reactions")
-    start_time = time.time()
+    if nodes:
+        write_compounds(writer, compounds, reaction_compounds(reactions, rclass), analytics)
+        if catalog is not None:
+            write_transformations(writer, catalog)
+    deltas = delta_mass_lookup(reaction_pairs(reactions, rclass), compounds)
+    # Edge phase - REACTION and CONNECTION relationships for each reaction class pair
+    connections = set()
     for index, reaction_ref in enumerate(reactions):
         react_data = dict()
         r = reactions[reaction_ref]
@@ -418,97 +1884,79 @@ def create_db_from_reactions(reactions, graph, enzymes=None, compounds=None, rcl
             for rc in r['rclass']:
                 # loop over reaction class and extract compound data
                 if rc[0] in rclass.keys():
+                    pair_data = dict(react_data)
                     # RClass
                     if "entry" in rclass[rc[0]]:
-                        react_data['rclass_entry'] = rclass[rc[0]]['entry']
+                        pair_data['rclass_entry'] = rclass[rc[0]]['entry']
                     if "definition" in rclass[rc[0]]:
-                        react_data['rclass_definition'] = rclass[rc[0]]['definition']
+                        pair_data['rclass_definition'] = rclass[rc[0]]['definition']
                     if "pathway" in rclass[rc[0]]:
-                        react_data['rclass_pathway'] = rclass[rc[0]]['pathway']
-                    if "definition" in rclass[rc[0]]:
-                        react_data['rclass_rpairs'] = rclass[rc[0]]['rpairs']
-                    # Compound 1
-                    if rc[1] in compounds.keys():
-                        cpd1 = "MERGE (c1:Compound {{{id}}})".format(id=flatten_dict(compounds[rc[1]]))
-                    else:
-                        cpd1 = "MERGE (c1:Compound {{entry: \"{id}\"}})".format(id=rc[1])
-                    # Compound 2
-                    if rc[2] in compounds.keys():
-                        cpd2 = "MERGE (c2:Compound {{{id}}})".format(id=flatten_dict(compounds[rc[2]]))
-                    else:
-                        cpd2 = "MERGE (c2:Compound {{entry: \"{id}\"}})".format(id=rc[2])
+                        pair_data['rclass_pathway'] = rclass[rc[0]]['pathway']
+                    if "rpairs" in rclass[rc[0]]:
+                        pair_data['rclass_rpairs'] = rclass[rc[0]]['rpairs']
                     # Mass change
-                    delta_mass = None
-                    if all([rc[1] in compounds.keys(), rc[2] in compounds.keys()]):
-                        if all(['mass' in compounds[rc[1]], 'mass' in compounds[rc[2]]]):
-                            delta_mass = round(compounds[rc[1]]['mass'] - compounds[rc[2]]['mass'], 4)
-                            react_data['delta_mass'] = delta_mass
-                            react_data['abs_delta_mass'] = abs(delta_mass)
-                    # generate MERGE for cypher transaction
-                    react = "[:REACTION {{{r}}}]".format(r=flatten_dict(react_data))
-                    merge_text = "{cpd1} {cpd2} MERGE (c1)-{react}-(c2)"\
-                        .format(cpd1=cpd1, react=react, cpd2=cpd2)
-                    tx.append(merge_text)
-                    # Create simple connection between pairs of compounds
+                    connection_data = dict()
+                    delta_mass = deltas.get((rc[1], rc[2]))
                     if delta_mass is not None:
-                        merge_text = "{cp1} {cp2} MERGE (c1)-[:CONNECTION {{abs_delta_mass: {m1}}}]-(c2)" \
-                            .format(cp1=cpd1, cp2=cpd2, m1=abs(delta_mass))
-                    else:
-                        merge_text = "{cp1} {cp2} MERGE (c1)-[:CONNECTION]-(c2)".format(cp1=cpd1, cp2=cpd2)
-                    cursors.append(tx.run(merge_text))
-    end_time = time.time()
-    print("Time to create transaction =", int(end_time - start_time), "seconds")
-    start_time = time.time()
-    tx.commit()
-    end_time = time.time()
-    print("Time to upload transaction =", int(end_time - start_time), "seconds")
+                        pair_data['delta_mass'] = delta_mass
+                        pair_data['abs_delta_mass'] = abs(delta_mass)
+                        connection_data['abs_delta_mass'] = abs(delta_mass)
+                        transformation = transformation_name(catalog, delta_mass)
+                        if transformation is not None:
+                            pair_data['transformation'] = transformation
+                            connection_data['transformation'] = transformation
+                    writer.merge_relationship("REACTION", rc[1], rc[2], pair_data, keys=("entry", "rclass_entry"))
+                    # Create simple connection between pairs of compounds, once per pair
+                    pair = tuple(sorted(rc[1:3]))
+                    if pair not in connections:
+                        connections.add(pair)
+                        writer.merge_relationship("CONNECTION", rc[1], rc[2], connection_data)
     return
 
 
 # Create and populate a neo4j database using data read from kgml (xml) files
 # Data are cross-referenced with compounds, reactions and enzyme
 # The KEGG xml files are incomplete and not all network reactions are detailed using this approach
-def create_db_from_xml(metabolic_reactions, graph, reactions=None, enzymes=None, compounds=None):
-    # clear old data
-    graph.delete_all()
-    # begin Cypher transaction
-    tx = graph.begin()
-    cursors = []
+def create_db_from_xml(metabolic_reactions, graph, reactions=None, enzymes=None, compounds=None, batch_size=5000,
+                       workers=None, connect=None, transformations=True):
+    with METRICS.stage("load_xml") as stage:
+        backend = graph_backend(graph)
+        # clear old data
+        backend.clear()
+        backend.create_schema()
+        catalog = transformation_catalog(xml_pairs(metabolic_reactions), compounds) \
+            if transformations else None
+        writer = backend.writer(batch_size, workers, connect)
+        with METRICS.stage("create_rows"):
+            write_xml(writer, metabolic_reactions, reactions, enzymes, compounds, catalog)
+        writer.close()
+        backend.mark_load()
+        backend.verify_schema()
+        stage['records'] = writer.rows
+        stage['statements'] = writer.batches
+    return
+
+
+# Generate compound nodes and REACTION and CONNECTION relationships from kgml reactions through a writer
+# With nodes=False only relationships are written, the compounds having been written already
+def write_xml(writer, metabolic_reactions, reactions=None, enzymes=None, compounds=None, catalog=None, nodes=True):
     # iterate over each member of metabolic_reactions and add to database
     # include optional data as properties if available
     print("Processing", len(metabolic_reactions), "reactions")
-    start_time = time.time()
+    if nodes:
+        write_compounds(writer, compounds, xml_compounds(metabolic_reactions))
+        if catalog is not None:
+            write_transformations(writer, catalog)
+    deltas = delta_mass_lookup(xml_pairs(metabolic_reactions), compounds)
+    connections = set()
     for index, m in enumerate(metabolic_reactions):
-        # Compound 1
-        if m["substrate"]["name"] in compounds.keys():
-            cpd1 = "MERGE (c1:Compound {{{id}}})".format(id=flatten_dict(compounds[m["substrate"]["name"]]))
-        else:
-            cpd1 = "MERGE (c1:Compound {{entry: \"{id}\"}})".format(id=m["substrate"]["name"])
-        # Compound 2
-        if m["product"]["name"] in compounds.keys():
-            cpd2 = "MERGE (c2:Compound {{{id}}})".format(id=flatten_dict(compounds[m["product"]["name"]]))
-        else:
-            cpd2 = "MERGE (c2:Compound {{entry: \"{id}\"}})".format(id=m["product"]["name"])
-        # Mass change
-        delta_mass = None
-        if all([m["substrate"]["name"] in compounds.keys(), m["product"]["name"] in compounds.keys()]):
-            if all(['mass' in compounds[m["substrate"]["name"]], 'mass' in compounds[m["product"]["name"]]]):
-                delta_mass = round(compounds[m["product"]["name"]]['mass'] -
-                                   compounds[m["substrate"]["name"]]['mass'], 4)
         # Reaction
-        if m["type"] == "reversible":
-            relation = "-"
-        else:
-            relation = "->"
-        react_data = dict()
-        react_data["type"] = m["type"]
-
-        # loop through reactions
+        directed = m["type"] != "reversible"
+        reaction_data = dict()
         for react_name in m["name"]:
+            react_data = dict()
+            react_data["type"] = m["type"]
             react_data["entry"] = react_name
-            if delta_mass is not None:
-                react_data["delta_mass"] = delta_mass
-                react_data["abs_delta_mass"] = abs(delta_mass)
             if react_name in reactions.keys():
                 if "definition" in reactions[react_name]:
                     react_data["definition"] = reactions[react_name]["definition"]
@@ -526,76 +1974,322 @@ def create_db_from_xml(metabolic_reactions, graph, reactions=None, enzymes=None,
                             react_data["enzyme_name"] = enzymes[enz]["name"]
                         if "pathway" in enzymes[enz]:
                             react_data["pathway"] = enzymes[enz]["pathway"]
-            # generate MERGE for cypher transaction
-            react = "[:REACTION {{{r}}}]".format(r=flatten_dict(react_data))
-            merge_text = "{cpd1} {cpd2} MERGE (c1)-{react}{relation}(c2)"\
-                .format(cpd1=cpd1, react=react, relation=relation, cpd2=cpd2)
-            tx.append(merge_text)
-        # Create simple connection between pairs of compounds
-        if delta_mass is not None:
-            merge_text = "{cp1} {cp2} MERGE (c1)-[:CONNECTION {{abs_delta_mass: \"{m1}\"}}]-(c2)"\
-                .format(cp1=cpd1, cp2=cpd2, m1=abs(delta_mass))
-        else:
-            merge_text = "{cp1} {cp2} MERGE (c1)-[:CONNECTION]-(c2)" .format(cp1=cpd1, cp2=cpd2)
-        cursors.append(tx.run(merge_text))
-
-    end_time = time.time()
-    print("Time to create transaction =", int(end_time - start_time), "seconds")
-    start_time = time.time()
-    tx.commit()
-    end_time = time.time()
-    print("Time to upload transaction =", int(end_time - start_time), "seconds")
+            reaction_data[react_name] = react_data
+        # loop through every substrate and product pair
+        for _, substrate in m["substrates"]:
+            for _, product in m["products"]:
+                # Mass change
+                delta_mass = deltas.get((product, substrate))
+                transformation = transformation_name(catalog, delta_mass)
+                for react_name in m["name"]:
+                    react_data = reaction_data[react_name]
+                    if delta_mass is not None:
+                        react_data = dict(react_data, delta_mass=delta_mass, abs_delta_mass=abs(delta_mass))
+                    if transformation is not None:
+                        react_data['transformation'] = transformation
+                    writer.merge_relationship("REACTION", substrate, product, react_data, keys=("entry",),
+                                              directed=directed)
+                # Create simple connection between pairs of compounds, once per pair
+                pair = tuple(sorted([substrate, product]))
+                if pair not in connections:
+                    connections.add(pair)
+                    connection_data = dict()
+                    if delta_mass is not None:
+                        connection_data['abs_delta_mass'] = abs(delta_mass)
+                    if transformation is not None:
+                        connection_data['transformation'] = transformation
+                    writer.merge_relationship("CONNECTION", substrate, product, connection_data)
     return
 
 
 # Create and populate a neo4j database using rclass and compound data
 # This is the simplest approach, however rclass data are non-directional
-def create_db_from_triples(triples, rclass, compounds, graph):
-    # clear old data
-    graph.delete_all()
-    # begin Cypher transaction
-    tx = graph.begin()
-    cursors = []
+def create_db_from_triples(triples, rclass, compounds, graph, batch_size=5000, workers=None, connect=None,
+                           transformations=True):
+    with METRICS.stage("load_triples") as stage:
+        backend = graph_backend(graph)
+        # clear old data
+        backend.clear()
+        backend.create_schema()
+        catalog = transformation_catalog(triple_pairs(triples), compounds) if transformations else None
+        writer = backend.writer(batch_size, workers, connect)
+        with METRICS.stage("create_rows"):
+            write_triples(writer, triples, rclass, compounds, catalog)
+        writer.close()
+        backend.mark_load()
+        backend.verify_schema()
+        stage['records'] = writer.rows
+        stage['statements'] = writer.batches
+    return
+
+
+# Generate compound nodes and REACTION relationships from rclass triples through a writer
+# With nodes=False only relationships are written, the compounds having been written already
+def write_triples(writer, triples, rclass, compounds, catalog=None, nodes=True):
     # iterate over each triple and add to database
     print("Processing", len(triples), "relationships")
-    start_time = time.time()
+    if nodes:
+        write_compounds(writer, compounds, triple_compounds(triples))
+        if catalog is not None:
+            write_transformations(writer, catalog)
+    deltas = delta_mass_lookup(triple_pairs(triples), compounds)
     for index, t in enumerate(triples):
-        # Lookup each value in triple.  If does not exist then return a record with just the Entry id
-        # Compound 1
-        if t[0] in compounds.keys():
-            cpd1 = "MERGE (c1:Compound {{{id}}})".format(id=flatten_dict(compounds[t[0]]))
-        else:
-            cpd1 = "MERGE (c1:Compound {{entry: \"{id}\"}})".format(id=t[0])
-        # Compound 2
-        if t[1] in compounds.keys():
-            cpd2 = "MERGE (c2:Compound {{{id}}})".format(id=flatten_dict(compounds[t[1]]))
-        else:
-            cpd2 = "MERGE (c2:Compound {{entry: \"{id}\"}})".format(id=t[1])
         # Reaction
         if t[2] in rclass.keys():
-            react_data = rclass[t[2]]
+            react_data = dict(rclass[t[2]])
         else:
             react_data = {'entry': t[2]}
         # Mass change
-        if all([t[0] in compounds.keys(), t[1] in compounds.keys()]):
-            if all(['mass' in compounds[t[0]], 'mass' in compounds[t[1]]]):
-                delta_mass = round(compounds[t[0]]['mass'] -
-                                   compounds[t[1]]['mass'], 4)
-                react_data['delta_mass'] = delta_mass
-                react_data['abs_delta_mass'] = abs(delta_mass)
-        react = "[:REACTION {{{r}}}]".format(r=flatten_dict(react_data))
-        merge_text = "{cpd1} {cpd2} MERGE (c1)-{react}-(c2)" \
-            .format(cpd1=cpd1, react=react, cpd2=cpd2)
-        cursors.append(tx.run(merge_text))
-    end_time = time.time()
-    print("Time to create transaction =", int(end_time - start_time), "seconds")
-    start_time = time.time()
-    tx.commit()
-    end_time = time.time()
-    print("Time to upload transaction =", int(end_time - start_time), "seconds")
+        delta_mass = deltas.get((t[0], t[1]))
+        if delta_mass is not None:
+            react_data['delta_mass'] = delta_mass
+            react_data['abs_delta_mass'] = abs(delta_mass)
+            transformation = transformation_name(catalog, delta_mass)
+            if transformation is not None:
+                react_data['transformation'] = transformation
+        writer.merge_relationship("REACTION", t[0], t[1], react_data, keys=("entry",))
     return
 
 
+# Create and populate one database holding the reaction, kgml and rclass triple models together
+# Compounds are written once for all models.  Every relationship is given a model property (MODELS) which is part of
+# its merge key, so the REACTION and CONNECTION relationships of different models stay separate and queries choose
+# a model with a filter such as WHERE r.model = 'kgml'.  Models whose data are None are left out.  Compound
+# analytics come from the reaction model and the transformation catalog from the delta masses of every model
+MODELS = {"reactions": "reactions", "kgml": "kgml", "triples": "rclass"}
+
+
+def create_db_unified(graph, reactions=None, metabolic_reactions=None, triples=None, enzymes=None, compounds=None,
+                      rclass=None, batch_size=5000, workers=None, connect=None, hub_degree=HUB_DEGREE,
+                      transformations=True):
+    with METRICS.stage("load_unified") as stage:
+        backend = graph_backend(graph)
+        # clear old data
+        backend.clear()
+        backend.create_schema()
+        entries = set()
+        pairs = list()
+        if reactions is not None:
+            entries.update(reaction_compounds(reactions, rclass))
+            pairs.extend(reaction_pairs(reactions, rclass))
+        if metabolic_reactions is not None:
+            entries.update(xml_compounds(metabolic_reactions))
+            pairs.extend(xml_pairs(metabolic_reactions))
+        if triples is not None:
+            entries.update(triple_compounds(triples))
+            pairs.extend(triple_pairs(triples))
+        analytics = graph_analytics(reactions, rclass, hub_degree) \
+            if hub_degree is not None and reactions is not None else None
+        catalog = transformation_catalog(pairs, compounds) if transformations else None
+        writer = backend.writer(batch_size, workers, connect)
+        with METRICS.stage("create_rows"):
+            write_compounds(writer, compounds, entries, analytics)
+            if catalog is not None:
+                write_transformations(writer, catalog)
+            if reactions is not None:
+                write_reactions(ModelWriter(writer, MODELS["reactions"]), reactions, enzymes, compounds, rclass,
+                                nodes=False, catalog=catalog)
+            if metabolic_reactions is not None:
+                write_xml(ModelWriter(writer, MODELS["kgml"]), metabolic_reactions, reactions, enzymes, compounds,
+                          catalog, nodes=False)
+            if triples is not None:
+                write_triples(ModelWriter(writer, MODELS["triples"]), triples, rclass, compounds, catalog,
+                              nodes=False)
+        writer.close()
+        backend.mark_load()
+        backend.verify_schema()
+        stage['records'] = writer.rows
+        stage['statements'] = writer.batches
+    return
+
+
+# Tag the relationships passed to a writer with the model which produced them
+class ModelWriter:
+    def __init__(self, writer, model):
+        self.writer = writer
+        self.model = model
+
+    def merge_node(self, label, properties, key="entry"):
+        self.writer.merge_node(label, properties, key)
+
+    def merge_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                           label="Compound", node_key="entry"):
+        properties = dict(properties or dict(), model=self.model)
+        self.writer.merge_relationship(rel_type, start, end, properties, ("model",) + tuple(keys), directed, label,
+                                       node_key)
+
+
+# Write neo4j-admin import files for a full rebuild from reactions, kgml reactions or rclass triples
+# These take the same inputs as the corresponding create_db_from_* functions, replacing the graph by a folder
+def create_csv_from_reactions(reactions, folder, enzymes=None, compounds=None, rclass=None, hub_degree=HUB_DEGREE,
+                              transformations=True):
+    writer = CsvWriter(folder)
+    with METRICS.stage("write_csv") as stage:
+        analytics = graph_analytics(reactions, rclass, hub_degree) if hub_degree is not None else None
+        catalog = transformation_catalog(reaction_pairs(reactions, rclass), compounds) \
+            if transformations else None
+        write_reactions(writer, reactions, enzymes, compounds, rclass, analytics=analytics, catalog=catalog)
+        writer.close()
+        stage['records'] = writer.rows
+    return
+
+
+def create_csv_from_xml(metabolic_reactions, folder, reactions=None, enzymes=None, compounds=None):
+    writer = CsvWriter(folder)
+    with METRICS.stage("write_csv") as stage:
+        write_xml(writer, metabolic_reactions, reactions, enzymes, compounds)
+        writer.close()
+        stage['records'] = writer.rows
+    return
+
+
+def create_csv_from_triples(triples, rclass, compounds, folder):
+    writer = CsvWriter(folder)
+    with METRICS.stage("write_csv") as stage:
+        write_triples(writer, triples, rclass, compounds)
+        writer.close()
+        stage['records'] = writer.rows
+    return
+
+
+# Write Compound and Reaction node tables and REACTION and CONNECTION edge tables from reactions in a columnar
+# format (see ColumnarWriter).  Reactions are placed in the pathways of their reaction classes
+def create_columnar_from_reactions(reactions, folder, enzymes=None, compounds=None, rclass=None, format="parquet",
+                                   compression=None, hub_degree=HUB_DEGREE, transformations=True):
+    writer = ColumnarWriter(folder, format, compression)
+    with METRICS.stage("write_columnar") as stage:
+        analytics = graph_analytics(reactions, rclass, hub_degree) if hub_degree is not None else None
+        catalog = transformation_catalog(reaction_pairs(reactions, rclass), compounds) \
+            if transformations else None
+        write_reactions(writer, reactions, enzymes, compounds, rclass, analytics=analytics, catalog=catalog)
+        for r in reactions.values():
+            properties = dict(r)
+            properties['rclass'] = [rc[0] for rc in r.get('rclass', [])]
+            properties['pathway'] = [p for rc in properties['rclass'] if rc in rclass
+                                     for p in rclass[rc].get('pathway', [])]
+            writer.merge_node("Reaction", properties)
+        tables = writer.close()
+        stage['records'] = writer.rows
+    return tables
+
+
+def record_hash(record):
+    # Short content hash of a parsed record or row
+    return hashlib.sha1(json.dumps(record, sort_keys=True, default=dict).encode()).hexdigest()[0:16]
+
+
+# Collect the rows generated by a write_* function in place of writing them
+# Rows are indexed by the identity of the node or relationship they merge, together with a content hash
+class RowCollector:
+    def __init__(self):
+        self.rows = dict()
+
+    def merge_node(self, label, properties, key="entry"):
+        self.rows[("node", label, key, properties[key])] = (record_hash(properties), properties)
+
+    def merge_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                           label="Compound", node_key="entry"):
+        properties = properties or dict()
+        self.rows[("relationship",) + relationship_key(rel_type, start, end, properties, keys, directed)] = \
+            (record_hash([start, end, properties]), (rel_type, start, end, properties, keys, directed, label, node_key))
+
+
+def read_manifest(manifest_file):
+    # Manifest of a previous load, or None if there has not been one
+    if not os.path.exists(manifest_file):
+        return None
+    with gzip.open(manifest_file, "rb") as f:
+        return pickle.load(f)
+
+
+def write_manifest(manifest_file, manifest):
+    with gzip.open(manifest_file + ".tmp", "wb", compresslevel=3) as f:
+        pickle.dump(manifest, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def diff_hashes(old, new):
+    # Keys added, changed and removed between two dictionaries of content hashes
+    added = [k for k in new if k not in old]
+    changed = [k for k in new if k in old and old[k] != new[k]]
+    removed = [k for k in old if k not in new]
+    return added, changed, removed
+
+
+# Bring a database built by create_db_from_reactions up to date with a new KEGG release
+# Each reaction, enzyme, rclass and compound record and each node and relationship row is hashed and compared
+# against the manifest of the previous load.  Only inserts, property updates and deletes for rows which have changed
+# are sent, so the graph stays queryable during the refresh.  If no manifest exists the graph is cleared and
+# fully loaded.  Returns the differences between the releases
+def sync_db_from_reactions(reactions, graph, manifest_file, enzymes=None, compounds=None, rclass=None,
+                           batch_size=5000, hub_degree=HUB_DEGREE, transformations=True):
+    backend = graph_backend(graph)
+    manifest = read_manifest(manifest_file)
+    if manifest is None:
+        print("No manifest found, loading all records")
+        backend.clear()
+        manifest = {"records": dict(), "rows": dict()}
+    backend.create_schema()
+    with METRICS.stage("compare_releases") as stage:
+        records = dict()
+        diff = dict()
+        for name, data in [("reactions", reactions), ("enzymes", enzymes), ("rclass", rclass),
+                           ("compounds", compounds)]:
+            records[name] = dict((entry, record_hash(record)) for entry, record in data.items())
+            added, changed, removed = diff_hashes(manifest["records"].get(name, dict()), records[name])
+            diff[name] = {"added": added, "changed": changed, "removed": removed}
+        collector = RowCollector()
+        analytics = graph_analytics(reactions, rclass, hub_degree) if hub_degree is not None else None
+        catalog = transformation_catalog(reaction_pairs(reactions, rclass), compounds) \
+            if transformations else None
+        write_reactions(collector, reactions, enzymes, compounds, rclass, analytics=analytics, catalog=catalog)
+        rows = dict((key, value[0]) for key, value in collector.rows.items())
+        old_rows = manifest["rows"]
+        added, changed, removed = diff_hashes(dict((key, value[0]) for key, value in old_rows.items()), rows)
+        stage['records'] = len(rows)
+
+    with METRICS.stage("sync_reactions") as stage:
+        writer = backend.writer(batch_size)
+        for key in removed:
+            if key[0] == "node":
+                label, node_key, value = old_rows[key][1]
+                writer.delete_node(label, value, node_key)
+            else:
+                rel_type, start, end, properties, keys, directed, label, node_key = old_rows[key][1]
+                writer.delete_relationship(rel_type, start, end, properties, keys, directed, label, node_key)
+        for key in added + changed:
+            if key[0] == "node":
+                _, label, node_key, _ = key
+                writer.merge_node(label, collector.rows[key][1], node_key, replace=True)
+            else:
+                writer.merge_relationship(*collector.rows[key][1], replace=True)
+        writer.close()
+        stage['records'] = writer.rows
+        stage['statements'] = writer.batches
+
+    # Record this load
+    new_rows = dict()
+    for key, (row_hash, row) in collector.rows.items():
+        if key[0] == "node":
+            new_rows[key] = (row_hash, (key[1], key[2], key[3]))
+        else:
+            rel_type, start, end, properties, keys, directed, label, node_key = row
+            new_rows[key] = (row_hash, (rel_type, start, end, dict((k, properties.get(k)) for k in keys), keys,
+                                        directed, label, node_key))
+    write_manifest(manifest_file, {"records": records, "rows": new_rows})
+    backend.mark_load()
+    backend.verify_schema()
+
+    diff["nodes"] = {"added": [k for k in added if k[0] == "node"], "changed": [k for k in changed if k[0] == "node"],
+                     "removed": [k for k in removed if k[0] == "node"]}
+    diff["relationships"] = {"added": [k for k in added if k[0] != "node"],
+                             "changed": [k for k in changed if k[0] != "node"],
+                             "removed": [k for k in removed if k[0] != "node"]}
+    for name, d in diff.items():
+        print(name + ":", len(d["added"]), "added,", len(d["changed"]), "changed,", len(d["removed"]), "removed")
+    return diff
+
+
 # A few tests to make sure we can execute cypher queries
 def test_database(graph):
     tests = list()
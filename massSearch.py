@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+import numpy as np
+
+
+# In-process index of reaction mass differences for fast ppm-window transformation searches
+# The index is a writer: pass it to one of the write_* functions in createDB in place of a BatchWriter and it keeps
+# the delta mass, reaction and compound pair of every REACTION relationship.  close() sorts the rows by absolute
+# delta mass, after which searches are binary searches over a contiguous array
+class DeltaMassIndex:
+    def __init__(self):
+        self.rows = list()
+        self.abs_delta_mass = np.zeros(0)
+        self.delta_mass = np.zeros(0)
+        self.reaction = np.zeros(0, dtype="U")
+        self.start = np.zeros(0, dtype="U")
+        self.end = np.zeros(0, dtype="U")
+
+    def merge_node(self, label, properties, key="entry"):
+        return
+
+    def merge_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                           label="Compound", node_key="entry"):
+        if rel_type == "REACTION" and properties and properties.get("delta_mass") is not None:
+            self.rows.append((properties["delta_mass"], properties["entry"], start, end))
+
+    def close(self):
+        if self.rows:
+            delta_mass, reaction, start, end = zip(*self.rows)
+            delta_mass = np.array(delta_mass, dtype=float)
+            order = np.argsort(np.abs(delta_mass), kind="stable")
+            self.delta_mass = delta_mass[order]
+            self.abs_delta_mass = np.abs(self.delta_mass)
+            self.reaction = np.array(reaction)[order]
+            self.start = np.array(start)[order]
+            self.end = np.array(end)[order]
+        self.rows = list()
+        print(len(self.abs_delta_mass), "delta masses indexed")
+
+    def __len__(self):
+        return len(self.abs_delta_mass)
+
+    # Positions of every indexed delta mass within a ppm window of each query mass
+    # Returns two arrays of equal length - the index of the query and the position of the matching row
+    def window(self, masses, ppm=10):
+        masses = np.atleast_1d(np.asarray(masses, dtype=float))
+        tolerance = np.abs(masses) * ppm / 1E6
+        lo = np.searchsorted(self.abs_delta_mass, masses - tolerance, side="left")
+        hi = np.searchsorted(self.abs_delta_mass, masses + tolerance, side="right")
+        return expand_ranges(lo, hi)
+
+    # Vectorized search for an array of query masses.  Returns a dictionary of arrays, one element per hit
+    def search_batch(self, masses, ppm=10):
+        masses = np.atleast_1d(np.asarray(masses, dtype=float))
+        query, position = self.window(masses, ppm)
+        return {"query": query,
+                "query_mass": masses[query],
+                "abs_delta_mass": self.abs_delta_mass[position],
+                "delta_mass": self.delta_mass[position],
+                "ppm": 1E6 * np.abs(masses[query] - self.abs_delta_mass[position]) / masses[query],
+                "reaction": self.reaction[position],
+                "start": self.start[position],
+                "end": self.end[position]}
+
+    # Search for a single mass.  Returns a list of dictionaries, one per hit
+    def search(self, mass, ppm=10):
+        hits = self.search_batch([mass], ppm)
+        return [{"reaction": str(hits["reaction"][i]), "start": str(hits["start"][i]), "end": str(hits["end"][i]),
+                 "delta_mass": float(hits["delta_mass"][i]), "ppm": float(hits["ppm"][i])}
+                for i in range(len(hits["query"]))]
+
+    def save(self, filename):
+        np.savez_compressed(filename, abs_delta_mass=self.abs_delta_mass, delta_mass=self.delta_mass,
+                            reaction=self.reaction, start=self.start, end=self.end)
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with np.load(filename) as data:
+            index.abs_delta_mass = data["abs_delta_mass"]
+            index.delta_mass = data["delta_mass"]
+            index.reaction = data["reaction"]
+            index.start = data["start"]
+            index.end = data["end"]
+        return index
+
+
+def expand_ranges(lo, hi):
+    # Expand a set of half-open ranges [lo, hi) into (range number, position) pairs without a Python loop
+    counts = hi - lo
+    query = np.repeat(np.arange(len(lo)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return query, np.repeat(lo, counts) + offsets
+
+
+# Mass offsets of common singly charged adducts, for converting an observed m/z to a neutral mass
+ADDUCTS = {"[M]": 0.0,
+           "[M+H]+": 1.007276,
+           "[M+NH4]+": 18.033823,
+           "[M+Na]+": 22.989218,
+           "[M+K]+": 38.963158,
+           "[M-H]-": -1.007276,
+           "[M+Cl]-": 34.969402}
+
+
+# Compound exact mass search engine for batch MS feature annotation
+# Built from the dictionary returned by createDB.kegg_compounds.  Compounds with an exact mass are held in a sorted
+# contiguous array so that tens of thousands of observed masses can be annotated in one vectorized call
+class CompoundMassIndex:
+    def __init__(self, compounds):
+        records = sorted((c for c in compounds.values() if "mass" in c), key=lambda c: c["mass"])
+        self.mass = np.array([c["mass"] for c in records], dtype=float)
+        self.entry = np.array([c["entry"] for c in records])
+        self.name = np.array([c.get("name", "") for c in records])
+        self.formula = np.array([c.get("formula", "") for c in records])
+        print(len(self.mass), "compound masses indexed")
+
+    def __len__(self):
+        return len(self.mass)
+
+    # Vectorized search for an array of observed masses within a ppm or Da tolerance (Da takes precedence)
+    # adducts is a list of names from ADDUCTS; each observed mass is tested as every adduct
+    # Returns a dictionary of arrays, one element per hit
+    def search_batch(self, masses, ppm=10, da=None, adducts=None):
+        masses = np.atleast_1d(np.asarray(masses, dtype=float))
+        if adducts is None:
+            adducts = ["[M]"]
+        offsets = np.array([ADDUCTS[a] for a in adducts])
+        # one row per combination of observed mass and adduct
+        neutral = (masses[:, None] - offsets[None, :]).ravel()
+        if da is not None:
+            tolerance = np.full(len(neutral), float(da))
+        else:
+            tolerance = np.abs(neutral) * ppm / 1E6
+        lo = np.searchsorted(self.mass, neutral - tolerance, side="left")
+        hi = np.searchsorted(self.mass, neutral + tolerance, side="right")
+        row, position = expand_ranges(lo, hi)
+        query = row // len(adducts)
+        return {"query": query,
+                "query_mass": masses[query],
+                "adduct": np.array(adducts)[row % len(adducts)],
+                "mass": self.mass[position],
+                "error_da": self.mass[position] - neutral[row],
+                "error_ppm": 1E6 * (self.mass[position] - neutral[row]) / self.mass[position],
+                "entry": self.entry[position],
+                "name": self.name[position],
+                "formula": self.formula[position]}
+
+    # Search for a single mass.  Returns a list of dictionaries, one per hit
+    def search(self, mass, ppm=10, da=None, adducts=None):
+        hits = self.search_batch([mass], ppm, da, adducts)
+        return [{"entry": str(hits["entry"][i]), "name": str(hits["name"][i]), "formula": str(hits["formula"][i]),
+                 "adduct": str(hits["adduct"][i]), "mass": float(hits["mass"][i]),
+                 "error_ppm": float(hits["error_ppm"][i])}
+                for i in range(len(hits["query"]))]
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+# Named, parameterised queries against a database built by createDB
+# Query text never changes between calls, so each query is planned once by the server
+QUERIES = {
+    "compound": "MATCH (c:Compound {entry: $entry}) "
+                "RETURN c.entry AS entry, c.name AS name, c.formula AS formula, c.mass AS mass, c.degree AS degree, "
+                "c.hub AS hub, c.component AS component, c.component_size AS component_size",
+    "neighbors": "MATCH (c:Compound {entry: $entry})-[r:CONNECTION]-(n:Compound) "
+                 "RETURN n.entry AS entry, n.name AS name, n.mass AS mass, r.abs_delta_mass AS abs_delta_mass",
+    "reactions_by_delta_mass": "MATCH (c1:Compound)-[r:REACTION]->(c2:Compound) "
+                               "WHERE r.abs_delta_mass >= $low AND r.abs_delta_mass <= $high "
+                               "AND ($model IS NULL OR r.model = $model) "
+                               "RETURN c1.entry AS start, r.entry AS reaction, c2.entry AS end, "
+                               "r.delta_mass AS delta_mass LIMIT $limit",
+    "reactions_by_transformation": "MATCH (c1:Compound)-[r:REACTION {transformation: $name}]->(c2:Compound) "
+                                   "WHERE $model IS NULL OR r.model = $model "
+                                   "RETURN c1.entry AS start, r.entry AS reaction, c2.entry AS end, "
+                                   "r.delta_mass AS delta_mass LIMIT $limit",
+    "transformations": "MATCH (t:Transformation) RETURN t.name AS name, t.mass AS mass, t.count AS count "
+                       "ORDER BY t.count DESC",
+    # Each model records the reaction class of a REACTION differently, so pairs are found by one query per model
+    # (see RCLASS_QUERIES).  The reactions and rclass models are index lookups on rclass_entry and entry; kgml
+    # reactions hold a list of reaction classes, which no index covers
+    "pairs_by_rclass_reactions": "MATCH (c1:Compound)-[r:REACTION {rclass_entry: $rclass}]->(c2:Compound) "
+                                 "RETURN DISTINCT c1.entry AS start, c2.entry AS end",
+    "pairs_by_rclass_rclass": "MATCH (c1:Compound)-[r:REACTION {entry: $rclass}]->(c2:Compound) "
+                              "RETURN DISTINCT c1.entry AS start, c2.entry AS end",
+    "pairs_by_rclass_kgml": "MATCH (c1:Compound)-[r:REACTION]->(c2:Compound) "
+                            "WHERE $rclass IN r.reaction_class "
+                            "RETURN DISTINCT c1.entry AS start, c2.entry AS end",
+    "connected": "MATCH (a:Compound {entry: $start}), (b:Compound {entry: $end}) "
+                 "RETURN a.component IS NOT NULL AND a.component = b.component AS connected",
+    # Hub compounds are not expanded, so paths run through specific rather than currency metabolites
+    "shortest_path": "MATCH (a:Compound {entry: $start}), (b:Compound {entry: $end}) "
+                     "WHERE a.component = b.component "
+                     "MATCH p = shortestPath((a)-[:CONNECTION*..10]-(b)) "
+                     "WHERE none(n IN nodes(p)[1..-1] WHERE n.hub) "
+                     "RETURN [n IN nodes(p) | n.entry] AS path",
+    "last_load": "MATCH (b:Build {name: 'kegg'}) RETURN b.loaded AS loaded"
+}
+
+# Reaction class query for each model of createDB.MODELS
+RCLASS_QUERIES = {"reactions": "pairs_by_rclass_reactions", "rclass": "pairs_by_rclass_rclass",
+                  "kgml": "pairs_by_rclass_kgml"}
+
+
+# Query layer for services reading the KEGG graph
+# Queries run on a bounded pool of connections opened with connect().  Results are kept in an LRU cache with a
+# time to live, which is cleared when a new load of the database is detected (see createDB.mark_load) or when
+# invalidate() is called.  Loads are checked for at most every check_interval seconds, so results may be stale for
+# up to check_interval seconds after a reload; check_interval=0 checks before every query.  Latency is recorded per
+# query name
+class QueryService:
+    def __init__(self, connect, pool_size=4, cache_size=10000, ttl=3600, check_interval=30):
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(connect())
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.latency = dict()
+        self.hits = dict()
+        self.misses = dict()
+        self.loaded = None
+        self.checked = 0
+        # increased by invalidate, so results read before a reload are not cached after it
+        self.generation = 0
+
+    @contextmanager
+    def connection(self):
+        graph = self.pool.get()
+        try:
+            yield graph
+        finally:
+            self.pool.put(graph)
+
+    def query(self, name, **parameters):
+        self.check_load()
+        key = (name, tuple(sorted(parameters.items())))
+        now = time.time()
+        with self.lock:
+            if key in self.cache and now - self.cache[key][0] < self.ttl:
+                self.cache.move_to_end(key)
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return self.cache[key][1]
+            self.misses[name] = self.misses.get(name, 0) + 1
+            generation = self.generation
+        start_time = time.perf_counter()
+        with self.connection() as graph:
+            result = graph.data(QUERIES[name], parameters)
+        elapsed = time.perf_counter() - start_time
+        with self.lock:
+            self.latency.setdefault(name, deque(maxlen=1000)).append(elapsed)
+            if generation == self.generation:
+                self.cache[key] = (now, result)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result
+
+    def compound(self, entry):
+        result = self.query("compound", entry=entry)
+        return result[0] if result else None
+
+    def neighbors(self, entry):
+        return self.query("neighbors", entry=entry)
+
+    # model restricts results to one model of a database built by createDB.create_db_unified, e.g. "kgml"
+    def reactions_by_delta_mass(self, mass, ppm=10, limit=1000, model=None):
+        tolerance = abs(mass) * ppm / 1E6
+        return self.query("reactions_by_delta_mass", low=mass - tolerance, high=mass + tolerance, limit=limit,
+                          model=model)
+
+    def reactions_by_transformation(self, name, limit=1000, model=None):
+        return self.query("reactions_by_transformation", name=name, limit=limit, model=model)
+
+    def transformations(self):
+        return self.query("transformations")
+
+    # Distinct (start, end) compound pairs of a reaction class over every model, or over one model such as "kgml"
+    def pairs_by_rclass(self, rclass, model=None):
+        models = [model] if model is not None else list(RCLASS_QUERIES)
+        pairs = OrderedDict()
+        for m in models:
+            for row in self.query(RCLASS_QUERIES[m], rclass=rclass):
+                pairs.setdefault((row["start"], row["end"]), row)
+        return list(pairs.values())
+
+    def connected(self, start, end):
+        result = self.query("connected", start=start, end=end)
+        return bool(result and result[0]["connected"])
+
+    def shortest_path(self, start, end):
+        # Compound entries along a shortest path avoiding hubs, or None.  Pairs in different components are
+        # rejected by the component check without a traversal
+        result = self.query("shortest_path", start=start, end=end)
+        return result[0]["path"] if result else None
+
+    def invalidate(self):
+        with self.lock:
+            self.cache.clear()
+            self.generation += 1
+
+    def check_load(self):
+        # Clear the cache if the database has been reloaded since the last check
+        # One thread makes each check; the lock is not held while the database is read
+        now = time.time()
+        with self.lock:
+            if self.check_interval and now - self.checked < self.check_interval:
+                return
+            self.checked = now
+        with self.connection() as graph:
+            result = graph.data(QUERIES["last_load"])
+        loaded = result[0]["loaded"] if result else None
+        with self.lock:
+            if loaded != self.loaded:
+                self.cache.clear()
+                self.generation += 1
+                self.loaded = loaded
+
+    # Latency in seconds per query name, over the most recent calls that reached the database
+    def stats(self):
+        stats = dict()
+        with self.lock:
+            for name in set(self.latency) | set(self.hits):
+                times = sorted(self.latency.get(name, []))
+                stats[name] = {"hits": self.hits.get(name, 0), "misses": self.misses.get(name, 0),
+                               "mean": sum(times) / len(times) if times else None,
+                               "p50": percentile(times, 50), "p95": percentile(times, 95)}
+        return stats
+
+
+def percentile(values, p):
+    # Nearest rank percentile of a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+import json
+import time
+import sqlite3
+from pandas import DataFrame
+import createDB
+
+
+# Tables and indexes of the embedded graph
+# Nodes are keyed on label, key property and value.  Relationships are keyed on their identity (see
+# createDB.relationship_key), so undirected relationships merge in either direction as they do in neo4j.  Compound
+# mass and reaction entry and delta mass are held in columns so they can be indexed; all properties are kept as JSON
+SQLITE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS nodes (label TEXT NOT NULL, node_key TEXT NOT NULL, value TEXT NOT NULL, "
+    "mass REAL, properties TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS relationships (identity TEXT NOT NULL, type TEXT NOT NULL, label TEXT NOT NULL, "
+    "node_key TEXT NOT NULL, start_value TEXT NOT NULL, end_value TEXT NOT NULL, entry TEXT, delta_mass REAL, "
+    "abs_delta_mass REAL, properties TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS builds (name TEXT PRIMARY KEY, loaded INTEGER)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS compound_entry ON nodes (label, node_key, value)",
+    "CREATE INDEX IF NOT EXISTS compound_mass ON nodes (label, mass)",
+    "CREATE INDEX IF NOT EXISTS compound_component ON nodes (label, json_extract(properties, '$.component'))",
+    "CREATE UNIQUE INDEX IF NOT EXISTS relationship_identity ON relationships (identity)",
+    "CREATE INDEX IF NOT EXISTS relationship_start ON relationships (label, node_key, start_value)",
+    "CREATE INDEX IF NOT EXISTS relationship_end ON relationships (label, node_key, end_value)",
+    "CREATE INDEX IF NOT EXISTS reaction_entry ON relationships (type, entry)",
+    "CREATE INDEX IF NOT EXISTS reaction_abs_delta_mass ON relationships (type, abs_delta_mass)",
+    "CREATE INDEX IF NOT EXISTS reaction_transformation ON relationships "
+    "(type, json_extract(properties, '$.transformation'))"
+]
+
+SQLITE_INDEXES = ["compound_entry", "compound_mass", "compound_component", "relationship_identity",
+                  "relationship_start", "relationship_end", "reaction_entry", "reaction_abs_delta_mass",
+                  "reaction_transformation"]
+
+
+# Embedded SQLite backend for the createDB loaders, e.g.
+#     backend = SqliteBackend("kegg.sqlite")
+#     createDB.create_db_from_reactions(reactions, backend, enzymes, compounds, rclass)
+# Loads need no server, and the file can be copied and queried offline as a fast cache for read-heavy jobs
+class SqliteBackend:
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+    def clear(self):
+        for table in ["relationships", "nodes", "builds"]:
+            self.connection.execute("DROP TABLE IF EXISTS " + table)
+        self.connection.commit()
+
+    def create_schema(self):
+        with createDB.METRICS.stage("create_schema") as stage:
+            for statement in SQLITE_SCHEMA:
+                self.connection.execute(statement)
+            self.connection.commit()
+            stage['statements'] = len(SQLITE_SCHEMA)
+
+    def writer(self, batch_size=5000, workers=None, connect=None):
+        # SQLite has a single writer, so batches are always written in turn
+        return SqliteWriter(self.connection, batch_size)
+
+    def mark_load(self):
+        self.connection.execute("INSERT OR REPLACE INTO builds (name, loaded) VALUES ('kegg', ?)",
+                                (int(time.time() * 1000),))
+        self.connection.commit()
+
+    def verify_schema(self):
+        indexes = set(row["name"] for row in self.connection.execute("SELECT name FROM sqlite_master "
+                                                                     "WHERE type = 'index'"))
+        problems = [name for name in SQLITE_INDEXES if name not in indexes]
+        for name in problems:
+            print("Schema check failed for", name, "- missing")
+        if not problems:
+            print("Schema verified")
+        return problems
+
+    def close(self):
+        self.connection.close()
+
+    # Queries, mirroring those of createDB.test_database
+    def query(self, statement, parameters=()):
+        return [dict(row) for row in self.connection.execute(statement, parameters)]
+
+    def relationship_types(self):
+        return [row["type"] for row in self.connection.execute("SELECT DISTINCT type FROM relationships "
+                                                               "ORDER BY type")]
+
+    def compound_entries(self, limit=10):
+        return [row["value"] for row in self.connection.execute("SELECT value FROM nodes WHERE label = 'Compound' "
+                                                                "LIMIT ?", (limit,))]
+
+    def relationships(self, rel_type, limit=25):
+        return self.query("SELECT start_value AS start, entry AS reaction, end_value AS end, properties "
+                          "FROM relationships WHERE type = ? LIMIT ?", (rel_type, limit))
+
+    def mass_search(self, mass, ppm=100, rel_type="REACTION", limit=25):
+        # Relationships whose absolute delta mass is within ppm of mass, as a range scan of the delta mass index
+        tolerance = abs(mass) * ppm / 1E6
+        return self.query("SELECT start_value AS start, entry AS reaction, end_value AS end, delta_mass "
+                          "FROM relationships WHERE type = ? AND abs_delta_mass BETWEEN ? AND ? LIMIT ?",
+                          (rel_type, mass - tolerance, mass + tolerance, limit))
+
+    def transformation(self, name, rel_type="REACTION", limit=None):
+        # Relationships of a transformation from the catalog (see createDB.transformation_catalog), e.g. H2O
+        return self.query("SELECT start_value AS start, entry AS reaction, end_value AS end, delta_mass "
+                          "FROM relationships WHERE type = ? AND json_extract(properties, '$.transformation') = ? "
+                          "LIMIT ?", (rel_type, name, -1 if limit is None else limit))
+
+    def compound(self, entry):
+        row = self.connection.execute("SELECT properties FROM nodes WHERE label = 'Compound' AND node_key = 'entry' "
+                                      "AND value = ?", (entry,)).fetchone()
+        return json.loads(row["properties"]) if row else None
+
+    def neighbors(self, entry, rel_type="CONNECTION"):
+        return self.query("SELECT end_value AS entry, abs_delta_mass FROM relationships WHERE type = ? "
+                          "AND label = 'Compound' AND node_key = 'entry' AND start_value = ? "
+                          "UNION SELECT start_value AS entry, abs_delta_mass FROM relationships WHERE type = ? "
+                          "AND label = 'Compound' AND node_key = 'entry' AND end_value = ?",
+                          (rel_type, entry, rel_type, entry))
+
+    def connected(self, start, end):
+        # Whether two compounds are in the same component of the CONNECTION graph (see createDB.graph_analytics)
+        components = dict((row["value"], row["component"]) for row in self.query(
+            "SELECT value, json_extract(properties, '$.component') AS component FROM nodes "
+            "WHERE label = 'Compound' AND node_key = 'entry' AND value IN (?, ?)", (start, end)))
+        return components.get(start) is not None and components.get(start) == components.get(end)
+
+    def test_database(self, mass_search=18.0105, ppm_limit=100):
+        print("\nReturn first 10 compound IDs")
+        print(self.compound_entries(10))
+        for r in self.relationship_types():
+            print("\nReturn first 25 relationships, type = {r}".format(r=r))
+            print(DataFrame(self.relationships(r)))
+            print("\nSearch for mass match - dehydration reactions, type = {r}".format(r=r))
+            print(DataFrame(self.mass_search(mass_search, ppm_limit, r)))
+        return
+
+
+# Write the rows of the createDB write_* functions to SQLite with executemany batches
+# Shares the batching and phase ordering of BatchWriter: each batch holds rows of one statement, and nodes are
+# written before the relationships which refer to them.  Relationships are only written when both end nodes exist,
+# as with MATCH in neo4j.  Merges without replace update the stored properties with json_patch, as SET += does
+class SqliteWriter(createDB.BatchWriter):
+    def merge_node(self, label, properties, key="entry", replace=False):
+        query = "INSERT INTO nodes (label, node_key, value, mass, properties) " \
+                "VALUES (:label, :node_key, :value, :mass, :properties) " \
+                "ON CONFLICT (label, node_key, value) DO UPDATE SET {update}"\
+            .format(update="mass = excluded.mass, properties = excluded.properties" if replace else
+                    "mass = coalesce(excluded.mass, mass), properties = json_patch(properties, excluded.properties)")
+        self.add((query,), {"label": label, "node_key": key, "value": properties[key],
+                            "mass": properties.get("mass"), "properties": json.dumps(properties)}, 2)
+
+    def merge_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                           label="Compound", node_key="entry", replace=False):
+        properties = properties or dict()
+        query = "INSERT INTO relationships (identity, type, label, node_key, start_value, end_value, entry, " \
+                "delta_mass, abs_delta_mass, properties) " \
+                "SELECT :identity, :type, :label, :node_key, :start, :end, :entry, :delta_mass, :abs_delta_mass, " \
+                ":properties WHERE EXISTS (SELECT 1 FROM nodes WHERE label = :label AND node_key = :node_key " \
+                "AND value = :start) AND EXISTS (SELECT 1 FROM nodes WHERE label = :label AND node_key = :node_key " \
+                "AND value = :end) " \
+                "ON CONFLICT (identity) DO UPDATE SET {update}"\
+            .format(update="entry = excluded.entry, delta_mass = excluded.delta_mass, "
+                           "abs_delta_mass = excluded.abs_delta_mass, properties = excluded.properties" if replace else
+                    "entry = coalesce(excluded.entry, entry), delta_mass = coalesce(excluded.delta_mass, delta_mass), "
+                    "abs_delta_mass = coalesce(excluded.abs_delta_mass, abs_delta_mass), "
+                    "properties = json_patch(properties, excluded.properties)")
+        self.add((query,), self.relationship_row(rel_type, start, end, properties, keys, directed, label, node_key), 3)
+
+    def delete_node(self, label, value, key="entry"):
+        queries = ("DELETE FROM relationships WHERE label = :label AND node_key = :node_key "
+                   "AND (start_value = :value OR end_value = :value)",
+                   "DELETE FROM nodes WHERE label = :label AND node_key = :node_key AND value = :value")
+        self.add(queries, {"label": label, "node_key": key, "value": value}, 1)
+
+    def delete_relationship(self, rel_type, start, end, properties=None, keys=(), directed=False,
+                            label="Compound", node_key="entry"):
+        self.add(("DELETE FROM relationships WHERE identity = :identity",),
+                 self.relationship_row(rel_type, start, end, properties or dict(), keys, directed, label, node_key), 0)
+
+    @staticmethod
+    def relationship_row(rel_type, start, end, properties, keys, directed, label, node_key):
+        identity = createDB.relationship_key(rel_type, start, end, properties, keys, directed) + (label, node_key)
+        return {"identity": json.dumps(identity), "type": rel_type, "label": label, "node_key": node_key,
+                "start": start, "end": end, "entry": properties.get("entry"),
+                "delta_mass": properties.get("delta_mass"), "abs_delta_mass": properties.get("abs_delta_mass"),
+                "properties": json.dumps(properties)}
+
+    def send(self, queries):
+        rows = self.pending.pop(queries, [])
+        if not rows:
+            return
+        start_time = time.time()
+        with self.graph:
+            for query in queries:
+                self.graph.executemany(query, rows)
+        self.elapsed += time.time() - start_time
+        self.rows += len(rows)
+        self.batches += 1